@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for setconf
+#
+# Run with: python bench.py [benchmark ...] [--save] [--compare] [--tolerance N]
+#
+# The "files" benchmark changes generated files with setconf.main, like the
+# command line would. The "startup" benchmark measures the time it takes to
+# import setconf with python -X importtime. --save stores the results in
+# bench_baseline.json and --compare fails if the throughput, peak memory or
+# startup time is worse than the stored baseline by more than the tolerance
+# (0.3 by default, meaning 30%).
+#
+
+import json
+from os import environ, remove
+from os.path import dirname, join
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from sys import argv, executable, exit as sysexit
+from tempfile import mkdtemp
+from time import perf_counter
+from timeit import repeat
+from tracemalloc import get_traced_memory, start as trace_start, stop as trace_stop
+
+import setconf
+from setconf import ASSIGNMENTS, COMMENT_MARKERS, NL, change_multiline, changeline, firstpart, splitassignment
+
+TESTCASES = join(dirname(__file__) or ".", "testcases")
+BASELINE = join(dirname(__file__) or ".", "bench_baseline.json")
+
+# The number of lines in each generated file
+LINES = 100000
+
+# Modules that setconf should only import when they are needed
+LAZY_MODULES = ["base64", "decimal", "fnmatch", "glob", "json", "multiprocessing", "setconf_tests", "shlex",
+                "socketserver", "tempfile"]
+
+
+def splitassignment_loop(line):
+    """The previous implementation of splitassignment, that tests every
+    assignment in ASSIGNMENTS with one scan each. Used for comparison."""
+    stripline = line.strip()
+    if not stripline:
+        return None, None, None
+    for commentsymbol in COMMENT_MARKERS:
+        if stripline.startswith(commentsymbol):
+            return None, None, None
+    assignment = b""
+    found = []
+    for ass in ASSIGNMENTS:
+        if ass in [b'+=', b'-=']:
+            continue
+        if ass in line:
+            found.append(ass)
+    if len(found) == 1:
+        assignment = found[0]
+    elif found:
+        firstpos = len(line)
+        firstassignment = b""
+        for ass in found:
+            pos = line.index(ass)
+            if pos < firstpos:
+                firstpos = pos
+                firstassignment = ass
+        assignment = firstassignment
+    if assignment:
+        fields = line.split(assignment, 1)
+        return fields[0], assignment, fields[1]
+    return None, None, None
+
+
+def testcase_lines():
+    """Return the lines of all the original testcase files"""
+    lines = []
+    for name in ["kernel_config", "printk", "PKGBUILD", "aurutils", "multiline", "testcase2", "sh"]:
+        with open(join(TESTCASES, name + ".orig"), 'rb') as f:
+            lines += f.read().split(setconf.NL)
+    return lines
+
+
+def best(f, number):
+    """Return the best time for calling f the given number of times, in seconds"""
+    return min(repeat(f, number=number, repeat=5))
+
+
+def bench_tokenizer():
+    lines = testcase_lines()
+    for line in lines:
+        if splitassignment(line) != splitassignment_loop(line):
+            print("splitassignment differs for %r" % (line))
+            return False
+
+    def loop():
+        for line in lines:
+            splitassignment_loop(line)
+
+    def scan():
+        for line in lines:
+            splitassignment(line)
+
+    before = best(loop, 10) / (10 * len(lines))
+    after = best(scan, 10) / (10 * len(lines))
+    print("tokenizer: %d lines, %.0f ns/line before, %.0f ns/line after, %.1fx faster" %
+          (len(lines), before * 1e9, after * 1e9, before / after))
+    return True
+
+
+def change_multiline_recursive(data, key, value, endstring=NL, searchfrom=0):
+    """The previous implementation of change_multiline, that copies the data
+    several times and recurses once per commented out key. Used for comparison."""
+    if key not in data:
+        return data
+    if endstring.endswith(b'$'):
+        endstring = endstring[:-1] + b'\n'
+    if (endstring != NL) and (endstring not in data):
+        return data
+    startpos = data.find(key, searchfrom)
+    if endstring in data:
+        endpos = data.find(endstring, startpos + 1)
+    else:
+        endpos = len(data) - 1
+    before = data[:startpos]
+    between = data[startpos:endpos + 1]
+    linestartpos = data[:startpos].rfind(NL) + 1
+    line = data[linestartpos:endpos + 1]
+    if not firstpart(line):
+        return change_multiline_recursive(data, key, value, endstring, endpos)
+    after = data[endpos + len(endstring):]
+    newbetween = changeline(between, value)
+    if between.endswith(NL) or (NL in between and endstring.endswith(NL)):
+        newbetween += NL
+    return before + newbetween + after
+
+
+def pkgbuild(entries, commented):
+    """Return a PKGBUILD with a sha256sums array with the given number of entries,
+    after the given number of commented out sha256sums arrays"""
+    array = b"sha256sums=(" + b"\n            ".join([b"'%064x'" % (i) for i in range(entries)]) + b")\n"
+    return b"pkgname=bench\npkgver=1\n" + (b"# " + array) * commented + array + b"\nbuild() {\n  make\n}\n"
+
+
+def bench_multiline():
+    value = b"('SKIP')"
+    for entries, commented in [(10000, 0), (10000, 10), (10000, 50)]:
+        data = pkgbuild(entries, commented)
+        if change_multiline(data, b"sha256sums", value, b")") != change_multiline_recursive(data, b"sha256sums", value, b")"):
+            print("change_multiline differs for %d entries and %d commented arrays" % (entries, commented))
+            return False
+        before = best(lambda: change_multiline_recursive(data, b"sha256sums", value, b")"), 10) / 10
+        after = best(lambda: change_multiline(data, b"sha256sums", value, b")"), 10) / 10
+        print("multiline: %d entries, %d commented, %.2f MB, %.2f ms before, %.2f ms after, %.1fx faster" %
+              (entries, commented, len(data) / 1e6, before * 1e3, after * 1e3, before / after))
+    # Many commented out arrays would exceed the recursion limit of the previous implementation
+    data = pkgbuild(10, 5000)
+    after = best(lambda: change_multiline(data, b"sha256sums", value, b")"), 10) / 10
+    print("multiline: 10 entries, 5000 commented, %.2f ms" % (after * 1e3))
+    return True
+
+
+def kernel_config(n):
+    """Return a kernel .config with n options, where every other option is not set"""
+    lines = [b"#", b"# Automatically generated file; DO NOT EDIT.", b"#"]
+    for i in range(n - len(lines)):
+        if i % 100 == 0:
+            lines.append(b"# Section %d" % (i // 100))
+        elif i % 2:
+            lines.append(b"# CONFIG_OPTION_%d is not set" % (i))
+        else:
+            lines.append(b"CONFIG_OPTION_%d=y" % (i))
+    return NL.join(lines) + NL
+
+
+def makefile(n):
+    """Return a Makefile with n lines of variables and rules, that ends with a counter"""
+    lines = []
+    for i in range(n - 1):
+        if i % 10 == 9:
+            lines.append(b"\t$(CC) $(CFLAGS_%d) -c file%d.c" % (i, i))
+        elif i % 10 == 8:
+            lines.append(b"file%d.o: file%d.c" % (i + 1, i + 1))
+        elif i % 2:
+            lines.append(b"CFLAGS_%d := -O2 -DVALUE=%d" % (i, i))
+        else:
+            lines.append(b"VAR_%d = value %d" % (i, i))
+    lines.append(b"COUNT=41")
+    return NL.join(lines) + NL
+
+
+def header(n):
+    """Return a C header with n lines of #defines and comments"""
+    lines = []
+    for i in range(n):
+        if i % 5 == 4:
+            lines.append(b"/* Comment for NAME_%d */" % (i + 1))
+        else:
+            lines.append(b"#define NAME_%d 0x%x" % (i, i))
+    return NL.join(lines) + NL
+
+
+def duplicates(n):
+    """Return a file where the same key is commented out n - 1 times before it is set"""
+    return NL.join([b"# timeout=%d" % (i) for i in range(n - 1)] + [b"timeout=30"]) + NL
+
+
+def pkgbuild_lines(n):
+    """Return a PKGBUILD with a sha256sums array of about n lines, after 10 commented out arrays"""
+    return pkgbuild(n // 11, 10)
+
+
+# The name, the generated contents and the setconf arguments, where None is the filename
+FILE_BENCHMARKS = [
+    ("changefile kernel_config", kernel_config, [None, "CONFIG_OPTION_%d" % (LINES - 202), "m"]),
+    ("changefile Makefile", makefile, [None, "VAR_%d" % (LINES - 100), "changed"]),
+    ("change_multiline PKGBUILD", pkgbuild_lines, [None, "sha256sums", "('SKIP')", ")"]),
+    ("uncomment kernel_config", kernel_config, ["-u", None, "CONFIG_OPTION_%d=y" % (LINES - 201)]),
+    ("uncomment duplicates", duplicates, ["-u", None, "timeout=%d" % (LINES - 2)]),
+    ("define header", header, ["-d", None, "NAME_%d=1" % (LINES - 10)]),
+    ("add new Makefile", makefile, ["-a", None, "NEW_VAR", "1"]),
+    ("add existing kernel_config", kernel_config, ["-a", None, "CONFIG_OPTION_%d" % (LINES - 202), "m"]),
+    ("+= Makefile", makefile, [None, "COUNT+=1"]),
+    ("changefile make dialect", makefile, ["--dialect=make", None, "VAR_%d" % (LINES - 100), "changed"]),
+    ("uncomment kconfig dialect", kernel_config, ["--dialect=kconfig", "-u", None, "CONFIG_OPTION_%d=y" % (LINES - 201)]),
+]
+
+
+def reset_state():
+    """Make setconf.main start over, like a new process would, so that nothing that is kept
+    in the module from an earlier run can make the later runs faster"""
+    environ.pop("SETCONF_CACHE", None)
+    setconf.disable_cache()
+    setconf.use_dialect(None)
+    setconf.ASYNC_EDITORS.clear()
+
+
+def run_file_benchmark(directory, contents, args, number):
+    """Change a fresh copy of the contents with setconf.main the given number of times.
+    Return the best time in seconds and the peak memory use in bytes."""
+    filename = join(directory, "bench.conf")
+    args = [filename if arg is None else arg for arg in args]
+    times = []
+    for _ in range(number):
+        with open(filename, 'wb') as f:
+            f.write(contents)
+        reset_state()
+        start = perf_counter()
+        setconf.main(args)
+        times.append(perf_counter() - start)
+    # Measure the memory use separately, since tracing slows down the code
+    with open(filename, 'wb') as f:
+        f.write(contents)
+    reset_state()
+    trace_start()
+    setconf.main(args)
+    peak = get_traced_memory()[1]
+    trace_stop()
+    remove(filename)
+    return min(times), peak
+
+
+def bench_files(number=5):
+    """Time changing generated files, and return the results by benchmark name"""
+    results = {}
+    directory = mkdtemp()
+    try:
+        for name, generate, args in FILE_BENCHMARKS:
+            contents = generate(LINES)
+            lines = contents.count(NL)
+            seconds, peak = run_file_benchmark(directory, contents, args, number)
+            results[name] = {"lines_per_second": int(lines / seconds), "peak_bytes": peak}
+            print("%-28s %7d lines %10.0f lines/s %8.2f ms %8.2f MB peak" %
+                  (name, lines, lines / seconds, seconds * 1e3, peak / 1e6))
+    finally:
+        rmtree(directory)
+    return results
+
+
+def importtime(directory):
+    """Import setconf in a new interpreter with -X importtime, with the bytecode cached
+    in the given directory. Return the time in microseconds and the imported modules."""
+    env = dict(environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    command = [executable, "-X", "importtime", "-X", "pycache_prefix=" + directory, "-c", "import setconf"]
+    process = Popen(command, cwd=dirname(setconf.__file__) or ".", env=env, stderr=PIPE)
+    _, output = process.communicate()
+    microseconds, modules = None, []
+    for line in output.decode("utf-8").splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line.split("|")
+        if fields[2].strip() == "setconf":
+            microseconds = int(fields[1])
+        modules.append(fields[2].strip())
+    return microseconds, modules
+
+
+def bench_startup(number=20):
+    """Time importing setconf, like every invocation of the command line does"""
+    directory = mkdtemp()
+    try:
+        # The first import writes the bytecode
+        _, modules = importtime(directory)
+        microseconds = min([importtime(directory)[0] for _ in range(number)])
+    finally:
+        rmtree(directory)
+    print("startup: %.2f ms to import setconf, %d modules" % (microseconds / 1e3, len(modules)))
+    imported = [name for name in LAZY_MODULES if name in modules]
+    if imported:
+        print("startup: setconf imports " + ", ".join(imported) + ", which should only be imported when needed")
+        sysexit(1)
+    return {"startup": {"import_microseconds": microseconds}}
+
+
+def compare(results, baseline, tolerance):
+    """Print the benchmarks that are worse than the baseline. Return True if there are none.
+    Measurements that end with "per_second" should be higher, the others lower."""
+    passes = True
+    for name in sorted(results):
+        for measurement, value in sorted(results[name].items()):
+            if measurement not in baseline.get(name, {}):
+                continue
+            ratio = value / float(baseline[name][measurement])
+            if measurement.endswith("per_second"):
+                worse = ratio < 1 - tolerance
+            else:
+                worse = ratio > 1 + tolerance
+            if worse:
+                print("%s: %s is %.0f%% of the baseline" % (name, measurement, ratio * 100))
+                passes = False
+    return passes
+
+
+BENCHMARKS = {
+    "files": bench_files,
+    "multiline": bench_multiline,
+    "startup": bench_startup,
+    "tokenizer": bench_tokenizer,
+}
+
+
+def main(args=argv[1:]):
+    save, check, tolerance, names = False, False, 0.3, []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == "--save":
+            save = True
+        elif arg == "--compare":
+            check = True
+        elif arg == "--tolerance" and args:
+            tolerance = float(args.pop(0))
+        elif arg in BENCHMARKS:
+            names.append(arg)
+        else:
+            print("Unknown benchmark or option: " + arg)
+            sysexit(1)
+    if (save or check) and not names:
+        names = ["files", "startup"]
+    results = {}
+    for name in names or sorted(BENCHMARKS):
+        result = BENCHMARKS[name]()
+        if isinstance(result, dict):
+            results.update(result)
+    if check:
+        try:
+            with open(BASELINE) as f:
+                baseline = json.load(f)
+        except IOError:
+            print("No baseline in " + BASELINE + ", run with --save first")
+            sysexit(1)
+        if not compare(results, baseline, tolerance):
+            sysexit(1)
+        print("No regressions compared to " + BASELINE)
+    if save:
+        with open(BASELINE, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
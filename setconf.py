@@ -29,13 +29,34 @@
 # Jul 2020
 #
 
-from sys import argv
+from sys import argv, stderr, stdin, stdout
 from sys import exit as sysexit
 from os import linesep as linesep_str
-from os.path import exists
-from tempfile import mkstemp
-from decimal import Decimal
-from base64 import b64decode
+from os import chmod, close, environ, fdopen, fstat, fsync, makedirs, remove, replace, stat, umask, urandom, utime
+from os import O_APPEND, O_CREAT, O_EXCL, O_RDONLY, O_RDWR, O_WRONLY
+from os import open as osopen
+from os import scandir
+from os.path import basename, dirname, exists, expanduser, isdir, join, realpath
+from itertools import accumulate
+from bisect import bisect_right
+from stat import S_IMODE
+from errno import EPERM
+from time import perf_counter
+
+try:
+    from os import chown
+except ImportError:
+    # Not available on Windows, where files do not have an owner and group id
+    chown = None
+try:
+    from os import O_BINARY
+except ImportError:
+    # Only needed on Windows
+    O_BINARY = 0
+import re
+
+# Modules that are only needed for some of the flags, like decimal for += and -=,
+# are imported where they are used, to keep the startup time down.
 
 VERSION = "0.7.7"
 
@@ -55,50 +76,313 @@ ASSIGNMENTS = [b'==', b'=>', b'+=', b'-=', b'?=',
 SINGLE_LINE_COMMENTS = [b"#", b"//", b"--"]
 MULTI_LINE_COMMENTS = [b"/*"]
 
+COMMENT_MARKERS = tuple(SINGLE_LINE_COMMENTS + MULTI_LINE_COMMENTS)
+
+# A #define or %define line with the key and the value, which is a string or character
+# literal or anything up to whitespace
+DEFINE_PATTERN = re.compile(br"[ \t]*[#%][ \t]*define[ \t]+(\S+)[ \t]+"
+                            br'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|\S+)')
+
+# A kernel configuration setting, "CONFIG_X=value" or "# CONFIG_X is not set"
+KCONFIG_PATTERN = re.compile(br"(?:# )?(CONFIG_[A-Za-z0-9_]+)(?:=| is not set$)")
+
+
+class Dialect(object):
+    """The assignments and comment markers of a file format. Only these are tried when
+    finding keys and values, see use_dialect. Assignments that are words, like "is",
+    only match after a space and before whitespace. The space is then part of the
+    assignment, since literals are faster to search for than lookbehinds. The filenames are patterns for fnmatch,
+    used by detect_dialect."""
+
+    def __init__(self, name, assignments, comments, multiline_comments=[], filenames=[], whole_words=True):
+        self.name = name
+        self.assignments = assignments
+        self.comments = comments
+        self.markers = tuple(comments + multiline_comments)
+        # Strip away comment marker + space if possible, if not, just strip away the comment marker
+        self.uncomment_markers = [x + b" " for x in comments] + comments
+        self.filenames = filenames
+        # The += and -= operators are skipped when finding keys and values
+        alternatives = []
+        for ass in assignments:
+            if ass in [b'+=', b'-=']:
+                continue
+            if whole_words and ass.isalpha():
+                alternatives.append(b" " + re.escape(ass) + br"(?=\s)")
+            else:
+                alternatives.append(re.escape(ass))
+        self.pattern = re.compile(b"|".join(alternatives))
+
+    def __repr__(self):
+        return "Dialect(%r)" % (self.name)
+
+
+# All assignments and comment markers are tried for files of unknown formats
+GENERIC = Dialect("generic", ASSIGNMENTS, SINGLE_LINE_COMMENTS, MULTI_LINE_COMMENTS, whole_words=False)
+
+DIALECTS = dict([(dialect.name, dialect) for dialect in [
+    GENERIC,
+    Dialect("kconfig", [b'=', b'is'], [b"#"],
+            filenames=[".config", "*.config", "config-*", "*defconfig"]),
+    Dialect("shell", [b'='], [b"#"],
+            filenames=["PKGBUILD", "APKBUILD", "*.sh", "*.bash", "*.install", ".bashrc", ".bash_profile", ".profile"]),
+    Dialect("make", [b'::=', b':=', b'?=', b'!=', b'='], [b"#"],
+            filenames=["Makefile", "makefile", "GNUmakefile", "Makefile.*", "*.mk", "*.mak"]),
+    Dialect("ini", [b'=', b':'], [b"#", b";"],
+            filenames=["*.ini", "*.cfg", "*.desktop", "*.service", "*.timer", "*.socket"]),
+    Dialect("header", [b'='], [b"//", b"#"], [b"/*"],
+            filenames=["*.h", "*.hh", "*.hpp", "*.hxx", "*.h.in"]),
+    Dialect("yaml", [b':'], [b"#"],
+            filenames=["*.yml", "*.yaml"]),
+]])
+
+# The first bytes of a file that select a dialect, when the filename does not, in the order they are tried
+DIALECT_CONTENTS = [
+    (re.compile(br"\A#![^\n]*sh\b"), "shell"),
+    (re.compile(br"^(?:# )?CONFIG_[A-Za-z0-9_]+(?:=| is not set)", re.M), "kconfig"),
+    (re.compile(br"^[ \t]*#[ \t]*(?:define|ifndef|include|pragma)\b", re.M), "header"),
+    (re.compile(br"\A---[ \t]*\r?\n"), "yaml"),
+    (re.compile(br"^\[[^\]\n]+\][ \t]*\r?$", re.M), "ini"),
+]
+
+# The dialect that is used for finding keys and values, see use_dialect
+DIALECT = GENERIC
+
+
+def use_dialect(dialect):
+    """Only try the assignments and comment markers of the given Dialect, or dialect name,
+    when finding keys and values from now on. None is the same as GENERIC.
+    Returns the dialect that was used before."""
+    global DIALECT
+    previous = DIALECT
+    if dialect is None:
+        dialect = GENERIC
+    elif not isinstance(dialect, Dialect):
+        dialect = DIALECTS[dialect]
+    DIALECT = dialect
+    return previous
+
+
+def detect_dialect(filename, data=None):
+    """Return the Dialect for a file, from the filename or else from the first bytes of the
+    contents. The contents are read from the file if not given. Returns GENERIC if the
+    format is not recognized."""
+    from fnmatch import fnmatchcase
+    name = basename(filename)
+    for dialect in DIALECTS.values():
+        for pattern in dialect.filenames:
+            if fnmatchcase(name, pattern):
+                return dialect
+    if data is None:
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read(4096)
+        except (IOError, OSError):
+            data = b""
+    head = data[:4096]
+    for pattern, dialectname in DIALECT_CONTENTS:
+        if pattern.search(head):
+            return DIALECTS[dialectname]
+    return GENERIC
+
+
+class Stats(object):
+    """Timings and counters for a run, see start_stats.
+    phases has the wall time in seconds for each phase, like "read", "uncomment",
+    "change" and "write". Every scanned line is either parsed or skipped without
+    being parsed, and matches is the number of lines where the key was found."""
+    __slots__ = ["phases", "started", "seconds", "bytes_read", "bytes_written", "lines_scanned",
+                 "lines_parsed", "lines_skipped", "matches", "peak_memory"]
+
+    def __init__(self):
+        self.phases = {}
+        self.started = perf_counter()
+        self.seconds = 0.0
+        self.bytes_read = self.bytes_written = 0
+        self.lines_scanned = self.lines_parsed = self.lines_skipped = self.matches = 0
+        # In bytes, or None if memory use was not traced
+        self.peak_memory = None
+
+    def timed(self, phase, start):
+        """Add the time since start, from perf_counter, to the given phase"""
+        self.phases[phase] = self.phases.get(phase, 0.0) + perf_counter() - start
+
+    def lines(self, parsed, skipped, matches):
+        """Count scanned lines"""
+        self.lines_scanned += parsed + skipped
+        self.lines_parsed += parsed
+        self.lines_skipped += skipped
+        self.matches += matches
+
+    def asdict(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__ if name != "started"])
+
+    def report(self):
+        """Return the timings and counters as human readable text"""
+        order = ["read", "uncomment", "change", "stream", "write"]
+        phases = sorted(self.phases, key=lambda phase: order.index(phase) if phase in order else len(order))
+        lines = ["%-16s%10.3f ms" % (phase, self.phases[phase] * 1e3) for phase in phases]
+        lines.append("%-16s%10.3f ms" % ("total", self.seconds * 1e3))
+        lines.append("%-16s%10d" % ("bytes read", self.bytes_read))
+        lines.append("%-16s%10d" % ("bytes written", self.bytes_written))
+        lines.append("%-16s%10d" % ("lines scanned", self.lines_scanned))
+        lines.append("%-16s%10d" % ("lines parsed", self.lines_parsed))
+        lines.append("%-16s%10d" % ("lines skipped", self.lines_skipped))
+        lines.append("%-16s%10d" % ("matches", self.matches))
+        if self.peak_memory is not None:
+            lines.append("%-16s%10d bytes" % ("peak memory", self.peak_memory))
+        return "\n".join(lines)
+
+
+# The Stats for the current run, or None if they are not collected
+STATS = None
+
+
+def start_stats(trace_memory=True):
+    """Start collecting timings and counters for everything that is done until
+    stop_stats is called. If trace_memory is True, the peak memory use is traced
+    with tracemalloc, which makes the code run slower. Returns the Stats."""
+    global STATS
+    STATS = Stats()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    return STATS
+
+
+def stop_stats():
+    """Stop collecting timings and counters. Returns the Stats, see start_stats."""
+    global STATS
+    stats, STATS = STATS, None
+    if stats is None:
+        return None
+    stats.seconds = perf_counter() - stats.started
+    import tracemalloc
+    if tracemalloc.is_tracing():
+        stats.peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return stats
+
+
+class ChangesFound(Exception):
+    """Raised by Check when a file would be changed and only that needs to be known"""
+
+
+class Check(object):
+    """Files that would be changed, for a run where nothing is written, see start_check.
+    The new contents are kept in memory instead, so that they are read back by readfile.
+    If diff is True, a unified diff is written to output, or to stdout, for each change.
+    If not, ChangesFound is raised by the first change, since the rest does not matter."""
+
+    def __init__(self, diff=False, output=None):
+        self.diff = diff
+        # A binary file for the diff
+        self.output = output
+        # The new contents, by real path
+        self.files = {}
+        # The real paths of files that would be created
+        self.created = set()
+        # The filenames of the files that would be changed
+        self.changed = []
+
+    def read(self, filename):
+        """Return the new contents of a file, or None if the file is not changed"""
+        return self.files.get(realpath(filename))
+
+    def write(self, filename, olddata, contents):
+        """Keep the contents that would be written to a file that had the old contents,
+        or None for a new file. Returns True if the contents differ."""
+        if contents == olddata:
+            return False
+        if filename not in self.changed:
+            self.changed.append(filename)
+        if not self.diff:
+            raise ChangesFound(filename)
+        path = realpath(filename)
+        self.files[path] = contents
+        if path in self.created:
+            olddata = None
+        from difflib import diff_bytes, unified_diff
+        old = olddata.splitlines(True) if olddata else []
+        name = bs(filename)
+        diff = diff_bytes(unified_diff, old, contents.splitlines(True),
+                          b"/dev/null" if olddata is None else name, name)
+        output = self.output
+        if output is None:
+            stdout.flush()
+            output = stdout.buffer
+        for line in diff:
+            if not line.endswith(b"\n"):
+                line += b"\n\\ No newline at end of file\n"
+            output.write(line)
+        output.flush()
+        return True
+
+    def create(self, filename):
+        """Keep an empty file in memory, for a file that would be created"""
+        path = realpath(filename)
+        if path not in self.files and not exists(path):
+            self.files[path] = b""
+            self.created.add(path)
+
+    def replace(self, filename, write):
+        """Call write with an in-memory file instead of a temporary file, see replacefile"""
+        from io import BytesIO
+        olddata = self.read(filename)
+        if olddata is None and exists(filename):
+            with open(filename, 'rb') as f:
+                olddata = f.read()
+        f = BytesIO()
+        if write(f) is False:
+            return False
+        return self.write(filename, olddata, f.getvalue())
+
+
+# The Check for the current run, or None if files are written
+CHECK = None
+
+
+def start_check(diff=False, output=None):
+    """Stop writing files, and keep track of which files would be changed until stop_check
+    is called. Returns the Check."""
+    global CHECK
+    CHECK = Check(diff, output)
+    return CHECK
+
+
+def stop_check():
+    """Write files again. Returns the Check, see start_check."""
+    global CHECK
+    check, CHECK = CHECK, None
+    return check
+
+
+def splitassignment(line):
+    """Return the key, assignment and value parts of a line,
+    or None, None, None if there is no assignment there."""
+    stripline = line.lstrip()
+    if not stripline:
+        return None, None, None
+    dialect = DIALECT
+    # Skip lines that start with a comment marker, like #, // or /*
+    if stripline.startswith(dialect.markers):
+        return None, None, None
+    # Find the first assignment in the line. If several assignments start at the
+    # same position, the one that comes first in the assignments of the dialect is used.
+    match = dialect.pattern.search(line)
+    if match:
+        return line[:match.start()], match.group(), line[match.end():]
+    # No assignments were found
+    return None, None, None
+
 
 def parts(line, including_assignment=True):
     """Return the key and value parts of a line, if there is an assignment there.
     May include the assignment as part of the key."""
-    stripline = line.strip()
-    if not stripline:
-        return None, None
-    # Skip lines that start with #, // or /*
-    for commentsymbol in SINGLE_LINE_COMMENTS + MULTI_LINE_COMMENTS:
-        if stripline.startswith(commentsymbol):
-            # Skip this line
-            return None, None
-    # These assignments are supported, in this order
-    assignment = b""
-    found = []
-    for ass in ASSIGNMENTS:
-        # Skip the += and -= operators when finding keys and values
-        if ass in [b'+=', b'-=']:
-            continue
-        # Collect the rest
-        if ass in line:
-            found.append(ass)
-    if len(found) == 1:
-        # Only one assignment were found
-        assignment = found[0]
-    elif found:  # > 1
-        # If several assignments are found, use the first one
-        firstpos = len(line)
-        firstassignment = b""
-        for ass in found:
-            pos = line.index(ass)
-            if pos < firstpos:
-                firstpos = pos
-                firstassignment = ass
-        assignment = firstassignment
-    # Return the "key" part of the line
-    if assignment:
-        fields = line.split(assignment, 1)
-        if including_assignment:
-            return fields[0] + assignment, fields[1]
-        else:
-            return fields[0], fields[1]
-    # No assignments were found
-    return None, None
+    key, assignment, value = splitassignment(line)
+    if assignment and including_assignment:
+        return key + assignment, value
+    return key, value
 
 
 def firstpart(line, including_assignment=True):
@@ -133,298 +417,1722 @@ def changeline(line, newvalue):
         return line
 
 
-def test_changeline():
-    passes = True
-    passes = passes and changeline(" // ost = 2", "3") == b" // ost = 2"
-    passes = passes and changeline("rabbits = DUMB", "cool") == b"rabbits = cool"
-    passes = passes and changeline(
-        "for ever and ever : never",
-        "and ever") == b"for ever and ever : and ever"
-    passes = passes and changeline(
-        "     for  ever  and  Ever   :=    beaver",
-        "TURTLE") == b"     for  ever  and  Ever   := TURTLE"
-    passes = passes and changeline("CC=g++", "baffled") == b"CC=baffled"
-    passes = passes and changeline("CC =\t\tg++", "baffled") == b"CC =\tbaffled"
-    passes = passes and changeline("cabal ==1.2.3", "1.2.4") == b"cabal ==1.2.4"
-    passes = passes and changeline(
-        "TMPROOT=${TMPDIR:=/tmp}",
-        "/nice/pants") == b"TMPROOT=/nice/pants"
-    passes = passes and changeline("    # ost = 2", "3") == b"    # ost = 2"
-
-    # The above passes, except for the first one
-
-    passes = passes and changeline("  ost = 2", "3") == b"  ost = 3"
-    passes = passes and changeline("   /* ost = 2 */", "3") == b"   /* ost = 2 */"
-    passes = passes and changeline("æøå =>\t123", "256") == bs("æøå =>\t256")
-    passes = passes and changeline("name=value # comment: whatever", "newvalue") == bs("name=newvalue")
-    passes = passes and changeline("name=value // comment: whatever", "newvalue") == bs("name=newvalue")
-    print("Changeline passes: %s" % (passes))
-    return passes
+def uncommentkey(line, key):
+    """If the line starts with a single line comment and the contents after the comment marker
+    start with the given key, return the line without the comment marker. If not, return None."""
+    stripped = line.strip()
+    # Strip away comment marker + space if possible, if not, just strip away the comment marker
+    for comment_marker in DIALECT.uncomment_markers:
+        if stripped.startswith(comment_marker):
+            commentpos = line.find(comment_marker)
+            after_comment_marker = line[commentpos + len(comment_marker):]
+            if after_comment_marker.strip().startswith(key):
+                return line[:commentpos] + after_comment_marker
+    return None
 
 
 def uncomment(lines, key):
     """Given a list of lines and a key, uncomment lines starting with a single line comment."""
     key = bs(key)
+    if STATS:
+        start = perf_counter()
+    skipped = matches = 0
 
     newlines = []
     for line in lines:
         if not line.strip():
             newlines.append(line)
+            skipped += 1
             continue
         else:
-            stripped = line.strip()
-            comment_markers = SINGLE_LINE_COMMENTS
-            # Strip away comment marker + space if possible, if not, just strip away the comment marker
-            for comment_marker in [x + b" " for x in comment_markers] + comment_markers:
+            uncommented = uncommentkey(line, key)
+            if uncommented is None:
+                # No uncommenting, the regular case
+                newlines.append(line)
+            else:
+                newlines.append(uncommented)
+                matches += 1
+    if STATS:
+        STATS.timed("uncomment", start)
+        STATS.lines(len(lines) - skipped, skipped, matches)
+    return newlines
+
+
+def changekeyline(line, key, value, uncomment_first=False):
+    """Change the value on a single line, if the line sets the given key. If uncomment_first
+    is True, the line is first uncommented if the contents start with the key.
+    Returns the line and True if the value was changed."""
+    if uncomment_first:
+        stripped = line.strip()
+        if stripped.startswith(DIALECT.markers):
+            for comment_marker in DIALECT.uncomment_markers:
                 if stripped.startswith(comment_marker):
-                    # Use the line, with the comment stripped away
                     commentpos = line.find(comment_marker)
                     after_comment_marker = line[commentpos + len(comment_marker):]
-                    stripped_contents = after_comment_marker.strip()
-                    if stripped_contents.startswith(key):
-                        newlines.append(line[:commentpos] + after_comment_marker)
+                    if after_comment_marker.strip().startswith(key):
+                        # Use the line, with the comment stripped away
+                        line = line[:commentpos] + after_comment_marker
                         break
-            else:
-                # No uncommenting, the regular case
-                newlines.append(line)
-    return newlines
+    firstp = firstpart(line, False)
+    if firstp and firstp.strip() == key:
+        return changeline(line, value), True
+    return line, False
 
 
-def test_uncomment():
-    testcontent = b"""y = 1
-// x = 42
-  #CONFIG_EVERYTHING=y
-z := 9
-"""
-    testcontent_changed = b"""y = 1
-// x = 42
-  CONFIG_EVERYTHING="ABSOLUTELY NOT"
-z := 9
-"""
-    passes = True
-    splitted = testcontent.split(NL)
-    splitted = uncomment(splitted, "CONFIG_EVERYTHING")
-    elements = change(splitted, "CONFIG_EVERYTHING", "\"ABSOLUTELY NOT\"")
-    a = bytes.join(b"", elements)
-    b = bytes.join(b"", testcontent_changed.split(NL))
-    passes = passes and a == b
-    print("Uncomment passes: %s" % (passes))
-    return passes
-
-
-def change(lines, key, value, define=False):
+def change_data(data, key, value, uncomment_first=False):
+    """Change the value for the given key in the file contents, with the same result as
+    joining the lines from change or uncomment_change. The key is searched for in the
+    whole contents, and only the lines where it is found are parsed. Everything else is
+    copied as it is. Returns the changed contents."""
+    key = bs(key)
+    value = bs(value)
+    if not key.strip() or NL in key:
+        # Any line may match
+        lines, final_nl = splitlines(data)
+        if uncomment_first:
+            return joinlines(data, lines, uncomment_change(lines, key, value), final_nl)
+        return joinlines(data, lines, change(lines, key, value), final_nl)
+    if STATS:
+        start = perf_counter()
+    parsed = matches = 0
+
+    # Trailing blank lines are removed, like splitlines does
+    end = len(data)
+    while data.endswith(NL + NL, 0, end):
+        end -= len(NL)
+    if end < len(data):
+        data = data[:end]
+    pieces = []
+    copied = 0
+    pos = data.find(key)
+    while pos != -1:
+        linestart = data.rfind(NL, 0, pos)
+        linestart = 0 if linestart == -1 else linestart + len(NL)
+        lineend = data.find(NL, pos)
+        if lineend == -1:
+            lineend = len(data)
+        parsed += 1
+        line = data[linestart:lineend]
+        newline, changed = changekeyline(line, key, value, uncomment_first)
+        if changed:
+            matches += 1
+        if newline != line:
+            pieces += [data[copied:linestart], newline]
+            copied = lineend
+        pos = data.find(key, lineend)
+    if STATS:
+        STATS.timed("change", start)
+        STATS.lines(parsed, data.count(NL) + (not data.endswith(NL)) - parsed, matches)
+    if not pieces:
+        return data
+    pieces.append(data[copied:])
+    return b"".join(pieces)
+
+
+def uncomment_change(lines, key, value, define=False, nth=0):
+    """Uncomment the given key, then change the value, in a single pass over the lines.
+    The result is the same as for change(uncomment(lines, key), key, value, define).
+    Lines that do not contain the key are neither uncommented nor changed, so they are
+    copied without being parsed. If nth is given, only the n'th occurrence of the key,
+    counted as if all the lines were uncommented, is uncommented and changed."""
+    if define:
+        return change(uncomment(lines, key), key, value, define=define)
+    if nth:
+        newlines = list(lines)
+        number, line = nthline(lines, key, nth, uncomment_first=True)
+        if number is not None:
+            newlines[number] = changeline(line, value)
+        return newlines
     key = bs(key)
     value = bs(value)
+    if STATS:
+        start = perf_counter()
+    parsed = matches = 0
+
+    newlines = list(lines)
+    for number, line in enumerate(lines):
+        if key not in line or not line.strip():
+            continue
+        parsed += 1
+        newlines[number], changed = changekeyline(line, key, value, True)
+        if changed:
+            matches += 1
+    if STATS:
+        STATS.timed("change", start)
+        STATS.lines(parsed, len(lines) - parsed, matches)
+    return newlines
+
 
+def change(lines, key, value, define=False, nth=0):
+    """Change the value for the given key. If nth is given, only change the n'th occurrence."""
+    key = bs(key)
+    value = bs(value)
+    if define:
+        return change_defines(lines, {key: value})
+    if STATS:
+        start = perf_counter()
+
+    if nth:
+        newlines = list(lines)
+        number, line = nthline(lines, key, nth)
+        if number is not None:
+            newlines[number] = changeline(line, value)
+        if STATS:
+            STATS.timed("change", start)
+        return newlines
+
+    skipped = matches = 0
     newlines = []
     for line in lines:
         if not line.strip():
             newlines.append(line)
+            skipped += 1
             continue
-        if define:
-            if line.strip().startswith(b"#define") and line.count(b" ") >= 2:
-                firstp = line.split()[1].strip()
-                oldvalue = line.split()[2].strip()
-                if firstp == key:
-                    newlines.append(line.replace(oldvalue, value))
-                    continue
-            newlines.append(line)
-            continue
-        else:
-            firstp = firstpart(line, False)
+        firstp = firstpart(line, False)
         if not firstp:
             newlines.append(line)
             continue
         elif firstp.strip() == key:
             newlines.append(changeline(line, value))
+            matches += 1
         else:
             newlines.append(line)
+    if STATS:
+        STATS.timed("change", start)
+        STATS.lines(len(lines) - skipped, skipped, matches)
     return newlines
 
 
-def test_change():
-    testcontent = b"""LIGHTS =    ON
-bananas= not present
-tea := yes
-    randombob    :ok
+def splitlines(data):
+    """Split the file contents into lines, without the trailing blank lines.
+    Also return True if the contents ended with a newline."""
+    if NL not in data:
+        return [data], False
+    lines = data.split(NL)
+    for idx in range(len(lines) - 1, 0, -1):
+        if lines[idx] != b'':
+            break
+        del lines[idx]
+    return lines, data.endswith(NL)
+
+
+def loadfile(filename):
+    """Read the contents of a file, or stdin if the filename is "-".
+    Errors are raised as IOError or OSError."""
+    if CHECK is not None:
+        data = CHECK.read(filename)
+        if data is not None:
+            return data
+    if STATS:
+        start = perf_counter()
+    if filename == "-":
+        data = stdin.buffer.read()
+    else:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    if STATS:
+        STATS.timed("read", start)
+        STATS.bytes_read += len(data)
+    return data
 
-"""
-    testcontent_changed = b"""LIGHTS = off
-bananas= not present
-tea := yes
-    randombob    :ok
 
-"""
-    passes = True
-    splitted = testcontent.split(NL)
-    elements = change(splitted, "LIGHTS", "off")
-    a = bytes.join(b"", elements)
-    b = bytes.join(b"", testcontent_changed.split(NL))
-    passes = passes and a == b
-    print("Change passes: %s" % (passes))
-    return passes
+def readfile(filename):
+    """Read the contents of a file, or exit with an error message."""
+    try:
+        return loadfile(filename)
+    except IOError:
+        print("Can't read %s" % (filename))
+        sysexit(2)
+
 
+def samecontents(f1, f2, chunksize=65536):
+    """Check if two open binary files have the same contents, one chunk at a time."""
+    while True:
+        chunk = f1.read(chunksize)
+        if chunk != f2.read(chunksize):
+            return False
+        if not chunk:
+            return True
 
-def test_change_define():
-    passes = True
 
-    testcontent = b"#define X 12"
-    testcontent_changed = b"#define X 42"
-    output = change([testcontent], "X", "42", define=True)[0]
-    passes = passes and output == testcontent_changed
+def createtemp(directory, prefix, mode=0o600):
+    """Create a new file that is only readable and writable by the current user,
+    like tempfile.mkstemp, but without importing tempfile. A different mode can be
+    given, which the umask is applied to. Returns a file descriptor and the filename."""
+    for _ in range(100):
+        filename = join(directory, prefix + urandom(6).hex())
+        try:
+            return osopen(filename, O_RDWR | O_CREAT | O_EXCL | O_BINARY, mode), filename
+        except FileExistsError:
+            continue
+    raise FileExistsError("No usable temporary filename in " + directory)
 
-    testcontent = b"   #define   X    12"
-    testcontent_changed = b"   #define   X    42"
-    output = change([testcontent], "X", "42", define=True)[0]
-    passes = passes and output == testcontent_changed
 
-    print("Change define passes: %s" % (passes))
-    return passes
+# The signatures of the files that have been replaced, by real path, while watch is
+# applying changes, or None
+WRITTEN = None
 
 
-def changefile(filename, key, value, dummyrun=False, define=False, uncomment_first=False):
-    """if dummyrun==True, don't write but return True if changes would have been made"""
+def keepstamp(path, f):
+    """Keep the signature of the open temporary file f, which will replace the file at the
+    given real path, for watch. Taken from the file descriptor, so that writes to the file
+    by something else after it is replaced do not get the same signature."""
+    f.flush()
+    WRITTEN[path] = filestamp(fstat(f.fileno()))
+
+
+def newtemp(filename, info):
+    """Create a temporary file next to the file it will replace, see createtemp. If info is
+    None, the file is new and the temporary file gets the default mode for new files, 0o666
+    with the umask applied. The umask is left alone, since it is shared by all threads."""
+    return createtemp(dirname(filename), "." + basename(filename) + ".", 0o600 if info else 0o666)
+
+
+def keepmode(tempname, info):
+    """Give a temporary file the mode and owner from the stat result of the file it will
+    replace. Nothing is done if info is None, see newtemp."""
+    if info is None:
+        return
+    chmod(tempname, S_IMODE(info.st_mode))
+    tempinfo = stat(tempname)
+    if (tempinfo.st_uid, tempinfo.st_gid) != (info.st_uid, info.st_gid):
+        chown(tempname, info.st_uid, info.st_gid)
+
+
+def replacefile(filename, write, sync=False, inplace=True):
+    """Write a file by calling write with an open temporary file in the same directory,
+    which then replaces the file, so that readers never see a partially written file.
+    The mode and owner of the file are kept. If write returns False, the contents are
+    unchanged and the file is left as it is. If sync is True, the data is flushed to
+    disk before the file is replaced, and the directory is flushed afterwards.
+    Returns True if the file was replaced. If a temporary file can not be created, or the
+    owner of the file can not be kept, the file is written in place instead, unless inplace
+    is False. Other errors are raised, and the file is left as it is."""
+    if CHECK is not None:
+        return CHECK.replace(filename, write)
+    # Replace the file that a symlink points to, not the symlink
+    filename = realpath(filename)
+    directory = dirname(filename)
+    try:
+        info = stat(filename)
+    except OSError:
+        info = None
+    try:
+        fd, tempname = newtemp(filename, info)
+    except (IOError, OSError):
+        fd, tempname = None, None
+    if fd is not None:
+        try:
+            with fdopen(fd, 'w+b') as f:
+                if write(f) is False:
+                    remove(tempname)
+                    return False
+                if sync:
+                    f.flush()
+                    fsync(f.fileno())
+                if WRITTEN is not None:
+                    keepstamp(filename, f)
+            keepmode(tempname, info)
+            replace(tempname, filename)
+        except OSError as e:
+            remove(tempname)
+            # Only a file with an owner that can not be kept is written in place. Other errors,
+            # like a full disk, must not leave a partially written file.
+            if e.errno != EPERM:
+                raise
+        except BaseException:
+            remove(tempname)
+            raise
+        else:
+            if sync:
+                syncdir(directory)
+            return True
+    if not inplace:
+        raise IOError("Can't write a temporary file for %s" % (filename))
+    # Write the file in place
+    with open(filename, 'r+b' if info else 'wb') as f:
+        f.seek(0)
+        if write(f) is False:
+            return False
+        f.truncate()
+        if sync:
+            f.flush()
+            fsync(f.fileno())
+    return True
+
+
+def syncdir(directory):
+    """Flush a directory to disk, so that renamed files are kept after a crash."""
+    try:
+        fd = osopen(directory, O_RDONLY)
+    except OSError:
+        # Not supported on all platforms
+        return
+    try:
+        fsync(fd)
+    except OSError:
+        pass
+    finally:
+        close(fd)
+
+
+def load_syncfs():
+    """Return the syncfs function from the C library, or None if it is not available,
+    which is the case outside of Linux."""
+    try:
+        from ctypes import CDLL
+        return CDLL(None, use_errno=True).syncfs
+    except (AttributeError, ImportError, OSError):
+        return None
+
+
+def savefile(filename, contents, olddata=None, sync=False):
+    """Write the contents to a file. Nothing is written if the contents are the same
+    as olddata. Returns True if the file was written, see replacefile.
+    If the filename is "-", the contents are always written to stdout.
+    Errors are raised as IOError or OSError."""
+    if filename == "-" and CHECK is None:
+        stdout.buffer.write(contents)
+        stdout.buffer.flush()
+        return contents != olddata
+    if contents == olddata:
+        return False
+    if CHECK is not None:
+        return CHECK.write(filename, olddata, contents)
+    if STATS:
+        start = perf_counter()
+    written = replacefile(filename, lambda f: f.write(contents) and None, sync)
+    if STATS:
+        STATS.timed("write", start)
+        STATS.bytes_written += len(contents) if written else 0
+    return written
+
+
+def writefile(filename, contents, olddata=None, sync=False):
+    """Write the contents to a file, or exit with an error message, see savefile."""
+    try:
+        return savefile(filename, contents, olddata, sync)
+    except (IOError, OSError):
+        print("No write permission: %s" % (filename))
+        sysexit(2)
+
+
+def changefile(filename, key, value, dummyrun=False, define=False, uncomment_first=False, nth=0, sync=False):
+    """if dummyrun==True, don't write but return True if changes would have been made.
+    if nth is given, only change the n'th occurrence of the key."""
 
     key = bs(key)
     value = bs(value)
 
     # Read the file
-    try:
-        with open(filename, 'rb') as f:
-            data = f.read()
-            lines = data.split(NL)
-            for idx in range(len(lines) - 1, 0, -1):
-                if lines[idx] != b'':
-                    break
-                del lines[idx]
-    except IOError:
-        print("Can't read %s" % (filename))
-        sysexit(2)
-    final_nl = True
-    if NL not in data:
-        lines = [data]
-        final_nl = False
-    elif not data.endswith(NL):
-        final_nl = False
+    data = readfile(filename)
     # Change and write the file
-    if uncomment_first:
-        changed_contents = NL.join(change(uncomment(lines, key), key, value, define=define))
+    if define or nth:
+        lines, final_nl = splitlines(data)
+        if uncomment_first:
+            changed_contents = NL.join(uncomment_change(lines, key, value, define=define, nth=nth))
+        else:
+            changed_contents = NL.join(change(lines, key, value, define=define, nth=nth))
+        # Only add a final newline if the original contents had one at the end
+        if final_nl:
+            changed_contents += NL
     else:
-        changed_contents = NL.join(change(lines, key, value, define=define))
-    # Only add a final newline if the original contents had one at the end
-    if final_nl:
-        changed_contents += NL
+        # Only the lines that contain the key are parsed
+        changed_contents = change_data(data, key, value, uncomment_first)
     if dummyrun:
         return data != changed_contents
-    try:
-        with open(filename, 'wb') as f:
-            f.write(changed_contents)
-    except IOError:
-        print("No write permission: %s" % (filename))
-        sysexit(2)
+    writefile(filename, changed_contents, data, sync)
 
 
-def addtofile(filename, line):
-    """Tries to add a line to a file. UTF-8. No questions asked."""
+def addtofile(filename, line, sync=False, data=None, after=None):
+    """Tries to add a line to a file. UTF-8. No questions asked.
+    data is the current contents of the file, if they have already been read.
+    The line is added at the end with a single write in append mode, and a newline
+    is added first if the file does not end with one. If the file ends with blank
+    lines, they are removed and the file is written again. If after is given, the line
+    is added after the first line that contains it instead, if there is one."""
 
     line = bs(line)
 
     # Read the file
+    if data is None:
+        data = readfile(filename)
+    if after is not None:
+        pos = data.find(bs(after))
+        if pos != -1:
+            # Add the line after the line where the string was found
+            end = data.find(NL, pos)
+            if end == -1:
+                return writefile(filename, data + NL + line + NL, data, sync)
+            end += len(NL)
+            return writefile(filename, data[:end] + line + NL + data[end:], data, sync)
+    if data.strip() == b"":
+        # Replace the blank contents
+        return writefile(filename, line + NL, data, sync)
+    if data.endswith(NL + NL):
+        # The trailing blank lines are removed before the line is added, like change_batch does
+        end = len(data)
+        while data.endswith(NL + NL, 0, end):
+            end -= len(NL)
+        return writefile(filename, data[:end] + line + NL, data, sync)
+    if not data.endswith(NL):
+        line = NL + line
+    line += NL
+    if CHECK is not None:
+        return CHECK.write(filename, data, data + line)
+    if STATS:
+        start = perf_counter()
     try:
-        with open(filename, 'rb') as f:
-            data = f.read()
-            lines = data.split(NL)[:-1]
+        fd = osopen(filename, O_WRONLY | O_APPEND | O_BINARY)
+    except OSError:
+        print("No write permission: %s" % (filename))
+        sysexit(2)
+    try:
+        with fdopen(fd, 'ab') as f:
+            f.write(line)
+            if sync:
+                f.flush()
+                fsync(f.fileno())
+    except (IOError, OSError):
+        print("No write permission: %s" % (filename))
+        sysexit(2)
+    if STATS:
+        STATS.timed("write", start)
+        STATS.bytes_written += len(line)
+    return True
+
+
+def addfile(filename, key, value, line=None, after=None, sync=False):
+    """Set the value for the given key, or add the line for the key if it is missing,
+    with a single read of the file. The line is key=value if it is not given.
+    A missing key is added with addtofile, which only rewrites the file if it is blank,
+    ends with blank lines or contains the after string."""
+    key = bs(key).strip()
+    value = bs(value)
+    if line is None:
+        line = key + b"=" + value
+
+    # Read the file
+    data = readfile(filename)
+    if key not in data:
+        return addtofile(filename, line, sync, data, after)
+    # Only the lines that contain the key are parsed
+    lines, final_nl = splitlines(data)
+    numbers = [number for number, candidate in enumerate(lines) if key in candidate]
+    present = False
+    newlines = list(lines)
+    for number, changed in zip(numbers, change_batch([lines[number] for number in numbers], [("set", key, value)])):
+        newlines[number] = changed
+        present = present or (firstpart(changed, False) or b"").strip() == key
+    if present:
+        # Change and write the file, if the value is not already set
+        return writefile(filename, joinlines(data, lines, newlines, final_nl), data, sync)
+    return addtofile(filename, line, sync, data, after)
+
+
+def iterlines(f, chunksize=65536):
+    """Yield the lines of an open binary file, split on NL, like data.split(NL) would.
+    Only one chunk and the current line are kept in memory at a time. Data from a pipe
+    is used as soon as it is available, instead of waiting for a whole chunk."""
+    read = getattr(f, "read1", f.read)
+    rest = b""
+    while True:
+        chunk = read(chunksize)
+        if not chunk:
+            break
+        if STATS:
+            STATS.bytes_read += len(chunk)
+        lines = (rest + chunk).split(NL)
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    yield rest
+
+
+def trimlines(lines, info):
+    """Yield the given lines without the trailing empty lines, like splitlines does.
+    When done, info["count"] is the number of lines that were yielded and
+    info["final_nl"] is True if the contents ended with a newline."""
+    pending = 0
+    count = 0
+    for line in lines:
+        if line == b"" and count > 0:
+            pending += 1
+            continue
+        for _ in range(pending):
+            yield b""
+        count += pending + 1
+        pending = 0
+        yield line
+    info["count"] = count
+    info["final_nl"] = pending > 0
+
+
+def streamlines(infile, outfile, edits):
+    """Read lines from infile, apply the edits and write the lines to outfile, one line
+    at a time. The result is the same as for changefile_batch, but the memory usage
+    depends on the longest line instead of on the size of the file."""
+    info = {}
+    # Blank lines at the start are held back, since the contents of a blank file
+    # are replaced by the lines that are added, if any.
+    held = []
+    written = 0
+    seen = 0
+    for line in iterchange_batch(trimlines(iterlines(infile), info), edits):
+        seen += 1
+        if held is not None:
+            if not line.strip():
+                held.append(line)
+                continue
+            if "count" in info:
+                # The first line that is not blank was added at the end
+                held = []
+            for heldline in held:
+                if written:
+                    outfile.write(NL)
+                outfile.write(heldline)
+                written += 1
+            held = None
+        if written:
+            outfile.write(NL)
+        outfile.write(line)
+        written += 1
+    for heldline in held or []:
+        if written:
+            outfile.write(NL)
+        outfile.write(heldline)
+        written += 1
+    # Only add a final newline if the original contents had one at the end, or if lines were added
+    if info["final_nl"] or seen > info["count"]:
+        outfile.write(NL)
+
+
+def streamfile(filename, edits, sync=False):
+    """Apply the edits to a file, reading and writing one line at a time.
+    The changed contents are written to a temporary file in the same directory,
+    which then replaces the original file if the contents were changed.
+    If the filename is "-", stdin is changed and written to stdout instead."""
+    if filename == "-":
+        if CHECK is not None:
+            from io import BytesIO
+            data = stdin.buffer.read()
+            output = BytesIO()
+            streamlines(BytesIO(data), output, edits)
+            return CHECK.write(filename, data, output.getvalue())
+        streamlines(stdin.buffer, stdout.buffer, edits)
+        stdout.buffer.flush()
+        return True
+    if STATS:
+        start = perf_counter()
+    try:
+        infile = open(filename, 'rb')
     except IOError:
         print("Can't read %s" % (filename))
         sysexit(2)
-    if data.strip() == b"":
-        lines = []
-    elif NL not in data:
-        lines = [data]
-    # Change and write the file
+    written = []
+
+    def write(outfile):
+        streamlines(infile, outfile, edits)
+        written.append(outfile.tell())
+        # Compare the written file with the original file
+        outfile.flush()
+        outfile.seek(0)
+        with open(filename, 'rb') as f:
+            if samecontents(f, outfile):
+                return False
+
+    with infile:
+        try:
+            replaced = replacefile(filename, write, sync, inplace=False)
+        except (IOError, OSError):
+            print("No write permission: %s" % (filename))
+            sysexit(2)
+    if STATS:
+        STATS.timed("stream", start)
+        STATS.bytes_written += written[0] if replaced else 0
+    return replaced
+
+
+def define_span(line):
+    """Return the key of a #define or %define line and the start and end of the value,
+    or None, None, None. String and character literals and values in parentheses are
+    kept together, other values end at the first whitespace."""
+    match = DEFINE_PATTERN.match(line)
+    if match is None:
+        return None, None, None
+    start, end = match.span(2)
+    if line[start:start + 1] == b"(":
+        depth = 0
+        for pos in range(start, len(line)):
+            if line[pos:pos + 1] == b"(":
+                depth += 1
+            elif line[pos:pos + 1] == b")":
+                depth -= 1
+                if not depth:
+                    return match.group(1), start, pos + 1
+    return match.group(1), start, end
+
+
+def changedefine(line, value):
+    """Replace the value of a #define or %define line, and nothing else."""
+    _, start, end = define_span(line)
+    return line[:start] + value + line[end:]
+
+
+def change_defines(lines, defines):
+    """Change the values of many #define or %define lines, given as a dictionary from keys
+    to values, in a single pass over the lines. Only lines that contain "define" are looked
+    at, and only the lines for one of the keys are tokenized."""
+    defines = dict([(bs(key).strip(), bs(value)) for key, value in defines.items()])
+    if STATS:
+        start = perf_counter()
+    parsed = matches = 0
+
+    newlines = list(lines)
+    for number, line in enumerate(lines):
+        if b"define" not in line:
+            continue
+        # Most lines can be skipped by the key, without tokenizing the value
+        fields = line.split(None, 2)
+        if len(fields) > 1 and fields[0] in [b"#define", b"%define"] and fields[1] not in defines:
+            continue
+        parsed += 1
+        key, valuestart, valueend = define_span(line)
+        if key in defines:
+            newlines[number] = line[:valuestart] + defines[key] + line[valueend:]
+            matches += 1
+    if STATS:
+        STATS.timed("change", start)
+        STATS.lines(parsed, len(lines) - parsed, matches)
+    return newlines
+
+
+def nthline(lines, key, nth, uncomment_first=False):
+    """Return the number of the line where the given key is set for the n'th time, and that line,
+    or None, None if the key is set fewer times. If uncomment_first is True, lines that comment out
+    the key are counted as if they were uncommented, and are returned uncommented.
+    Only the lines that contain the key are parsed."""
+    key = bs(key)
+    strippedkey = key.strip()
+    parsed = 0
+    for number, line in enumerate(lines):
+        if strippedkey not in line:
+            continue
+        parsed += 1
+        if uncomment_first:
+            uncommented = uncommentkey(line, key)
+            if uncommented is not None:
+                line = uncommented
+        linekey, _, _ = splitassignment(line)
+        if linekey is not None and linekey.strip() == strippedkey:
+            nth -= 1
+            if not nth:
+                if STATS:
+                    STATS.lines(parsed, len(lines) - parsed, 1)
+                return number, line
+    if STATS:
+        STATS.lines(parsed, len(lines) - parsed, 0)
+    return None, None
+
+
+def uncommentline(line):
+    """If the line starts with a single line comment, return the line without the
+    comment marker and the stripped contents after the marker. If not, return None, None."""
+    stripped = line.strip()
+    for comment_marker in DIALECT.uncomment_markers:
+        if stripped.startswith(comment_marker):
+            commentpos = line.find(comment_marker)
+            after_comment_marker = line[commentpos + len(comment_marker):]
+            return line[:commentpos] + after_comment_marker, after_comment_marker.strip()
+    return None, None
+
+
+def keylines(data, key):
+    """Yield the lines of the given file contents that contain the given key, in order.
+    The key must not be blank. Only these lines need to be parsed when looking for a key."""
+    pos = data.find(key)
+    while pos != -1:
+        linestart = data.rfind(NL, 0, pos)
+        linestart = 0 if linestart == -1 else linestart + len(NL)
+        lineend = data.find(NL, pos)
+        if lineend == -1:
+            lineend = len(data)
+        yield data[linestart:lineend]
+        pos = data.find(key, lineend)
+
+
+def parse_edit(args):
+    """Given command line arguments for one change, like ["-u", "CONFIG_X=y"] or ["CC", "gcc"],
+    return an (operation, key, value) tuple, or None if the arguments can not be used.
+    The operation is "set", "add", "uncomment", "define", "+=" or "-=".
+    For "add", the line to add is given as a fourth element, if needed."""
+    op = "set"
+    rest = []
+    for arg in args:
+        if arg in ["-a", "--add"]:
+            op = "add"
+        elif arg in ["-d", "--define"] and op != "add":
+            op = "define"
+        elif arg in ["-u", "--uncomment"] and op == "set":
+            op = "uncomment"
+        else:
+            rest.append(bs(arg))
+    if len(rest) == 2:
+        return (op, rest[0], rest[1])
+    if len(rest) != 1:
+        return None
+    keyvalue = rest[0]
+    if op == "set":
+        for ass in [b"+=", b"-=", b"="]:
+            if ass in keyvalue:
+                key, value = keyvalue.split(ass, 1)
+                return (op if ass == b"=" else ass.decode(), key, value)
+        return None
+    assignment = None
+    for ass in ASSIGNMENTS:
+        if ass in keyvalue:
+            assignment = ass
+            break
+    if not assignment:
+        if op == "uncomment":
+            # No assignment symbol, use the argument as the key
+            return (op, keyvalue, b"")
+        return None
+    _, value = keyvalue.split(assignment, 1)
+    key = firstpart(keyvalue, False)
+    if key is None:
+        return None
+    if op == "add":
+        return (op, key, value, keyvalue)
+    return (op, key, value)
+
+
+def read_edits(filename, parse=None):
+    """Read edits from a file with one change per line, given as command line arguments,
+    like "-u CONFIG_X=y" or "CC gcc". Empty lines and lines starting with # are skipped.
+    Use "-" for reading from stdin. The text is parsed by parse_edits, or by the given
+    function, like parse_file_edits."""
     try:
-        with open(filename, 'wb') as f:
-            lines.append(line)
-            added_data = NL.join(lines) + NL
-            f.write(added_data)
-    except IOError:
-        print("No write permission: %s" % (filename))
+        if filename == "-":
+            data = stdin.read()
+        else:
+            with open(filename, 'rb') as f:
+                data = f.read().decode("utf-8")
+    except (IOError, UnicodeDecodeError):
+        print("Can't read %s" % (filename))
+        sysexit(2)
+    try:
+        return (parse or parse_edits)(data)
+    except ValueError as e:
+        print("%s in %s" % (e, filename))
         sysexit(2)
 
 
-def test_changefile():
-    # Test data
-    testcontent = b"keys := missing" + NL + bs("døg = found") + NL * 3 + bs("æøåÆØÅ") + NL
-    testcontent_changed = b"keys := found" + NL + \
-        bs("døg = missing") + NL * 3 + bs("æøåÆØÅ") + NL
-    filename = mkstemp()[1]
-    # Write the testfile
-    with open(filename, 'wb') as f:
-        f.write(testcontent)
-    # Change the file with changefile
-    changefile(filename, "keys", "found")
-    changefile(filename, "døg", "missing")
-    # Read the file
-    with open(filename, 'rb') as f:
-        newcontent = f.read().split(NL)[:-1]
-    # Do the tests
-    passes = True
-    passes = passes and newcontent == testcontent_changed.split(NL)[:-1]
-    print("Changefile passes: %s" % (passes))
-    return passes
-
-
-def test_changefile_uncomment():
-    # Test data
-    testcontent = b"""#   y = 1
-// x = 42
-  #DESTROY_EVERYTHING=y
-# z  :=  123
-"""
-    testcontent_changed = b"""  y = 2
-x = 9000
-  #DESTROY_EVERYTHING=y
-z  := 7
-"""
-    filename = mkstemp()[1]
-    # Write the testfile
-    with open(filename, 'wb') as f:
-        f.write(testcontent)
-    # Change the file with changefile
-    changefile(filename, "x", "9000", uncomment_first=True)
-    changefile(filename, "DESTROY_EVERYTHING", "!IGNORED!", uncomment_first=False)
-    changefile(filename, "z", "7", uncomment_first=True)
-    changefile(filename, "y", "2", uncomment_first=True)
+def parse_edits(data, filenames=False):
+    """Return the edits for the given text with one change per line, see read_edits.
+    If filenames is True, each line starts with the filename that the change is for,
+    and (filename, edit) tuples are returned. Raises ValueError if a line can not be used."""
+    from shlex import split as shlexsplit
+    edits = []
+    for number, line in enumerate(data.splitlines(), 1):
+        if not line.strip() or line.strip().startswith("#"):
+            continue
+        try:
+            args = shlexsplit(line)
+            if filenames:
+                edit = parse_edit(args[1:]) if len(args) > 1 else None
+            else:
+                edit = parse_edit(args)
+        except ValueError:
+            edit = None
+        if edit is None:
+            raise ValueError("Can't use line %d: %s" % (number, line))
+        edits.append((args[0], edit) if filenames else edit)
+    return edits
+
+
+def parse_file_edits(data):
+    """Return (filename, edit) tuples for the given text with one filename and change per
+    line, like "/etc/foo.conf -u timeout 30", see parse_edits."""
+    return parse_edits(data, filenames=True)
+
+
+def change_batch(lines, edits):
+    """Apply a list of edits to the given lines in a single pass over the lines.
+    The result is the same as when applying the edits one by one, like main() would.
+    See parse_edit for the format of the edits. Keys that are missing for "add"
+    edits are added at the end. If all the edits are for #defines, see change_defines."""
+    if edits and not [edit for edit in edits if edit[0] != "define"]:
+        return change_defines(lines, dict([edit[1:3] for edit in edits]))
+    if STATS:
+        start = perf_counter()
+        newlines = list(iterchange_batch(lines, edits))
+        STATS.timed("change", start)
+        return newlines
+    return list(iterchange_batch(lines, edits))
+
+
+def iterchange_batch(lines, edits):
+    """Like change_batch, but takes any iterable of lines and yields the changed lines."""
+    edits = [(e[0], bs(e[1]).strip()) + tuple(bs(x) for x in e[2:]) for e in edits]
+
+    # Which edits may apply to which keys, as lists of edit indices
+    keyed = {}
+    defines = {}
+    uncomments = {}
+    for index, edit in enumerate(edits):
+        op, key = edit[0], edit[1]
+        if op == "define":
+            defines.setdefault(key, []).append(index)
+            continue
+        keyed.setdefault(key, []).append(index)
+        if op == "uncomment":
+            uncomments.setdefault(key, []).append(index)
+    # Commented out lines are uncommented if the contents start with the key
+    prefix_lengths = sorted(set(len(key) for key in uncomments))
+    # The values for += and -= are found at the first occurrence of the key
+    resolved = {}
+
+    def candidates(line):
+        """Return the edit indices that may apply to the line, and the key of the line"""
+        if not line.strip():
+            return [], None
+        found = []
+        if defines:
+            key, _, _ = define_span(line)
+            if key is not None:
+                found += defines.get(key, [])
+        first = firstpart(line, False)
+        if first:
+            key = first.strip()
+            return found + keyed.get(key, []), key
+        if first is not None:
+            return found, None
+        if uncomments:
+            _, contents = uncommentline(line)
+            if contents is not None:
+                for length in prefix_lengths:
+                    found += uncomments.get(contents[:length], [])
+        return found, None
+
+    def applyedit(line, linekey, index):
+        """Apply a single edit to a line, where the edit is known to match"""
+        op, key, value = edits[index][:3]
+        if op == "define":
+            return changedefine(line, value)
+        if linekey is None:
+            # Uncomment the line, then set the value if the key matches
+            line, _ = uncommentline(line)
+            first = firstpart(line, False)
+            if not first or first.strip() != key:
+                return line
+        elif op in ["+=", "-="]:
+            if index not in resolved:
+                _, oldvalue = parts(line, False)
+                if oldvalue:
+                    oldvalue = oldvalue.strip()
+                resolved[index] = (inc if op == "+=" else dec)(oldvalue, value)
+            value = resolved[index]
+        return changeline(line, value)
+
+    # The edit index from which each key that may be added has been present
+    added = set([edit[1] for edit in edits if edit[0] == "add"])
+    present = {}
+    # The number of edits that have been applied, in a list so that apply can change it
+    matches = [0]
+
+    def apply(line, after):
+        """Apply the edits that come after the given edit index, in order"""
+        since = after
+        indices, key = candidates(line)
+        while True:
+            following = [index for index in indices if index > after]
+            if not following:
+                break
+            after = min(following)
+            matches[0] += 1
+            line = applyedit(line, key, after)
+            indices, newkey = candidates(line)
+            if newkey != key:
+                since, key = after, newkey
+        if key in added and present.get(key, since + 1) > since:
+            present[key] = since
+        return line
+
+    scanned = skipped = 0
+    for line in lines:
+        scanned += 1
+        if not line.strip():
+            # No edits apply to blank lines
+            skipped += 1
+            yield line
+            continue
+        yield apply(line, -1)
+    for index, edit in enumerate(edits):
+        if edit[0] == "add" and present.get(edit[1], index + 1) > index:
+            if len(edit) > 3:
+                line = edit[3]
+            else:
+                line = edit[1] + b"=" + edit[2]
+            present[edit[1]] = index
+            yield apply(line, index)
+    if STATS:
+        STATS.lines(scanned - skipped, skipped, matches[0])
+
+
+def change_contents(data, edits):
+    """Apply many edits to the given file contents, see change_batch.
+    If a ResultCache is enabled, see enable_cache, the result is looked up there first.
+    Returns the changed contents."""
+    if CACHE is not None:
+        return CACHE.change(data, edits)
+    lines, final_nl = splitlines(data)
+    return joinlines(data, lines, change_batch(lines, edits), final_nl)
+
+
+# The default size limit for the ResultCache, in bytes
+CACHE_SIZE = 64 * 1024 * 1024
+
+
+class ResultCache(object):
+    """A cache on disk for the results of change_contents, for many files with the same
+    contents that get the same edits. The results are stored in files named by a hash of
+    the setconf version, the dialect, the edits and the contents, so that they are only found again for
+    identical input. Unchanged contents are only stored as a marker. When the files in the
+    directory take up more than maxsize bytes, the least recently used ones are removed.
+    The directory is only scanned for the first result that is stored, and then again
+    when the results that were stored since may have made it larger than maxsize."""
+
+    def __init__(self, directory, maxsize=CACHE_SIZE):
+        self.directory = directory
+        self.maxsize = maxsize
+        # The size of the files in the directory, as of the last scan and the results
+        # that were stored since, or None before the first scan
+        self.size = None
+
+    def path(self, data, edits):
+        """Return the path of the file for the result of the given contents and edits"""
+        from hashlib import sha256
+        edits = [(edit[0],) + tuple(bs(x) for x in edit[1:]) for edit in edits]
+        digest = sha256(repr((VERSION, NL, DIALECT.name, edits)).encode("utf-8") + b"\0")
+        digest.update(data)
+        return join(self.directory, digest.hexdigest())
+
+    def get(self, data, edits):
+        """Return the cached result for the given contents and edits, or None"""
+        path = self.path(data, edits)
+        try:
+            with open(path, 'rb') as f:
+                result = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            # Keep track of which results were used recently
+            utime(path)
+        except OSError:
+            # A read-only cache, or the result was evicted by another process
+            pass
+        if result == b"=":
+            return data
+        if result.startswith(b"+"):
+            return result[1:]
+        return None
+
+    def put(self, data, edits, result):
+        """Store the result for the given contents and edits, then remove old results
+        if the cache is too large. Errors are ignored, since the cache is optional."""
+        try:
+            if not isdir(self.directory):
+                makedirs(self.directory, 0o700)
+            fd, tempname = createtemp(self.directory, ".")
+            contents = b"=" if result == data else b"+" + result
+            with fdopen(fd, 'wb') as f:
+                f.write(contents)
+            replace(tempname, self.path(data, edits))
+            if self.size is not None:
+                self.size += len(contents)
+            if self.size is None or self.size > self.maxsize:
+                self.evict()
+        except (IOError, OSError):
+            pass
+
+    def evict(self):
+        """Remove the least recently used results until the cache fits in maxsize bytes"""
+        entries = []
+        for entry in scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                remove(path)
+            except OSError:
+                # Already removed by another process
+                pass
+            total -= size
+        self.size = total
+
+    def change(self, data, edits):
+        """Return the changed contents, from the cache or from change_contents"""
+        result = self.get(data, edits)
+        if result is None:
+            lines, final_nl = splitlines(data)
+            result = joinlines(data, lines, change_batch(lines, edits), final_nl)
+            self.put(data, edits, result)
+        return result
+
+
+# The ResultCache that is used by change_contents, or None if results are not cached
+CACHE = None
+
+
+def default_cache():
+    """Return the default cache directory, from $SETCONF_CACHE or in $XDG_CACHE_HOME or ~/.cache"""
+    if environ.get("SETCONF_CACHE"):
+        return environ["SETCONF_CACHE"]
+    return join(environ.get("XDG_CACHE_HOME") or join(expanduser("~"), ".cache"), "setconf")
+
+
+def enable_cache(directory=None, maxsize=CACHE_SIZE):
+    """Cache the results of change_contents in the given directory, see ResultCache.
+    Uses default_cache if no directory is given. Returns the ResultCache."""
+    global CACHE
+    CACHE = ResultCache(directory or default_cache(), maxsize)
+    return CACHE
+
+
+def disable_cache():
+    """Stop caching the results of change_contents"""
+    global CACHE
+    CACHE = None
+
+
+def lineoffsets(lines):
+    """Return the offset of the start of each line, for lines that were split on NL."""
+    return [0] + list(accumulate([len(line) + len(NL) for line in lines[:-1]]))
+
+
+def change_lines(data, lines, final_nl, offsets, edits):
+    """Like change_contents, for contents that have already been split by splitlines,
+    with the offsets of the lines from lineoffsets. Only the lines that contain one of
+    the keys are parsed, since the edits can not change any of the other lines."""
+    numbers = set()
+    for key in set([bs(edit[1]).strip() for edit in edits]):
+        if not key:
+            numbers = range(len(lines))
+            break
+        pos = data.find(key)
+        while pos != -1:
+            numbers.add(bisect_right(offsets, pos) - 1)
+            pos = data.find(key, pos + 1)
+    numbers = sorted(numbers)
+    if STATS:
+        # The lines that do not contain any of the keys are skipped
+        STATS.lines(0, len(lines) - len(numbers), 0)
+    changed = change_batch([lines[number] for number in numbers], edits)
+    newlines = list(lines)
+    for number, line in zip(numbers, changed):
+        newlines[number] = line
+    return joinlines(data, lines, newlines + changed[len(numbers):], final_nl)
+
+
+def joinlines(data, lines, newlines, final_nl):
+    """Join the changed lines for the original contents and lines, from splitlines.
+    Returns the changed contents."""
+    if len(newlines) > len(lines):
+        # Lines were added at the end
+        final_nl = True
+        if not data.strip():
+            newlines = newlines[len(lines):]
+    changed_contents = NL.join(newlines)
+    # Only add a final newline if the original contents had one at the end
+    if final_nl:
+        changed_contents += NL
+    return changed_contents
+
+
+class Line(object):
+    """A parsed line in a ConfigFile, as offsets into the contents. keystart and keyend
+    are the span of the stripped key and valuestart is where the value starts, or None
+    if the line has no assignment. commented is True if the line is commented out."""
+    __slots__ = ["start", "end", "keystart", "keyend", "valuestart", "assignment", "commented"]
+
+    def __init__(self, data, start, end):
+        self.start = start
+        self.end = end
+        self.keystart = self.keyend = self.valuestart = self.assignment = None
+        self.commented = False
+        line = data[start:end]
+        key, assignment, _ = splitassignment(line)
+        if key is None:
+            uncommented, _ = uncommentline(line)
+            if uncommented is None:
+                return
+            key, assignment, _ = splitassignment(uncommented)
+            if key is None:
+                return
+            self.commented = True
+            # The comment marker comes before the key
+            start += len(line) - len(uncommented)
+        self.keystart = start + len(key) - len(key.lstrip())
+        self.keyend = start + len(key.rstrip())
+        self.valuestart = start + len(key) + len(assignment)
+        self.assignment = assignment
+
+
+class ConfigFile(object):
+    """A configuration file that is read once and then kept in memory.
+    Lines are only parsed when they may contain a key that is asked for, and changes are
+    collected and applied in a single pass when needed. Errors are raised as exceptions.
+
+    Example:
+        conf = ConfigFile("/etc/ssh/sshd_config")
+        conf.uncomment("PermitRootLogin", "no")
+        if conf.get("X11Forwarding") != b"no":
+            conf.set("X11Forwarding", "no")
+        conf.save()
+    """
+    __slots__ = ["filename", "data", "changed", "pending", "parsed"]
+
+    def __init__(self, filename, data=None):
+        self.filename = filename
+        if data is None:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        self.data = bs(data)
+        # True if the contents differ from the file
+        self.changed = False
+        # Edits that are not applied yet, see change_batch
+        self.pending = []
+        # Parsed lines, by the offset of the start of the line
+        self.parsed = {}
+
+    def flush(self):
+        """Apply the changes that have been made, in one pass"""
+        if not self.pending:
+            return
+        lines, final_nl = splitlines(self.data)
+        data = change_lines(self.data, lines, final_nl, lineoffsets(lines), self.pending)
+        self.pending = []
+        if data != self.data:
+            self.data = data
+            self.changed = True
+            self.parsed = {}
+
+    def lines(self, key):
+        """Return the parsed lines where the given key is set, in order"""
+        self.flush()
+        key = bs(key).strip()
+        found = []
+        if not key or NL in key:
+            # Keys are never blank, and never span lines
+            return found
+        pos = self.data.find(key)
+        while pos != -1:
+            start = self.data.rfind(NL, 0, pos)
+            start = 0 if start == -1 else start + len(NL)
+            end = self.data.find(NL, pos)
+            if end == -1:
+                end = len(self.data)
+            line = self.parsed.get(start)
+            if line is None:
+                line = self.parsed[start] = Line(self.data, start, end)
+            if not line.commented and line.keystart is not None and self.data[line.keystart:line.keyend] == key:
+                found.append(line)
+            pos = self.data.find(key, end)
+        return found
+
+    def get(self, key, default=None, nth=1):
+        """Return the value for the given key, or for the n'th occurrence of the key.
+        Returns default if the key is not set."""
+        found = self.lines(key)
+        if len(found) < nth:
+            return default
+        line = found[nth - 1]
+        return self.data[line.valuestart:line.end].strip()
+
+    def __contains__(self, key):
+        return len(self.lines(key)) > 0
+
+    def set(self, key, value):
+        """Set the value for the given key"""
+        self.pending.append(("set", key, value))
+
+    def add(self, key, value):
+        """Set the value for the given key, or add key=value at the end if the key is missing"""
+        self.pending.append(("add", key, value))
+
+    def uncomment(self, key, value=b""):
+        """Uncomment the given key, then set the value"""
+        self.pending.append(("uncomment", key, value))
+
+    def define(self, key, value):
+        """Set the value of a #define"""
+        self.pending.append(("define", key, value))
+
+    def save(self, filename=None, sync=False):
+        """Write the changes to the file, or to the given filename.
+        Returns True if the file was written."""
+        self.flush()
+        if filename is None:
+            if not self.changed:
+                return False
+            filename = self.filename
+        data = self.data
+        replacefile(filename, lambda f: f.write(data) and None, sync)
+        if filename == self.filename:
+            self.changed = False
+        return True
+
+
+def editfile(filename, edits, sync=False):
+    """Apply many edits to a file, like changefile_batch, but raise IOError or OSError
+    instead of exiting. A missing file is created if there are edits that add keys.
+    Returns True if the file was changed."""
+    data = None
+    if [edit for edit in edits if edit[0] == "add"] and not exists(filename):
+        data = b""
+    conf = ConfigFile(filename, data)
+    conf.pending += list(edits)
+    return conf.save(sync=sync)
+
+
+class Transaction(object):
+    """Changes to many files that are written together. The changed files are written to
+    temporary files first, which then replace all the files at once when the transaction
+    is committed. If anything fails before that, none of the files are changed. If sync is
+    True, each filesystem is flushed to disk once before the files are replaced, with
+    syncfs where available, and each directory is flushed once afterwards.
+    Errors are raised as IOError or OSError.
+
+    Example:
+        with Transaction(sync=True) as transaction:
+            transaction.set("/etc/foo.conf", "timeout", "30")
+            transaction.file("/etc/sysctl.d/99-foo.conf").add("vm.swappiness", "10")
+    """
+
+    def __init__(self, sync=False):
+        self.sync = sync
+        # The ConfigFile and the original contents, or None for new files, by real path
+        self.files = {}
+
+    def file(self, filename, create=False):
+        """Return the ConfigFile for a file in the transaction, reading the file the first
+        time. If create is True, a missing file is created when the transaction is committed."""
+        path = realpath(filename)
+        entry = self.files.get(path)
+        if entry is None:
+            if create and not exists(path):
+                entry = self.files[path] = (ConfigFile(path, b""), None)
+            else:
+                conf = ConfigFile(path)
+                entry = self.files[path] = (conf, conf.data)
+        return entry[0]
+
+    def batch(self, filename, edits):
+        """Apply many edits to a file, see editfile"""
+        create = len([edit for edit in edits if edit[0] == "add"]) > 0
+        self.file(filename, create).pending += list(edits)
+
+    def set(self, filename, key, value):
+        """Set the value for the given key in a file"""
+        self.file(filename).set(key, value)
+
+    def rollback(self):
+        """Forget all the changes, without writing any of the files"""
+        self.files = {}
+
+    def commit(self):
+        """Write all the changed files, see Transaction. Returns the filenames of the files
+        that were changed, as real paths."""
+        changed = []
+        for path, (conf, original) in sorted(self.files.items()):
+            conf.flush()
+            if conf.data != original:
+                changed.append((path, conf.data, original))
+        if CHECK is not None:
+            for path, data, original in changed:
+                CHECK.write(path, original, data)
+            self.files = {}
+            return [path for path, _, _ in changed]
+        syncfs = load_syncfs() if self.sync else None
+        # Write the new contents to temporary files next to the files they will replace
+        temps = []
+        try:
+            for path, data, original in changed:
+                try:
+                    info = stat(path)
+                except OSError:
+                    info = None
+                fd, tempname = newtemp(path, info)
+                temps.append(tempname)
+                with fdopen(fd, 'wb') as f:
+                    f.write(data)
+                    if self.sync and syncfs is None:
+                        f.flush()
+                        fsync(f.fileno())
+                    if WRITTEN is not None:
+                        keepstamp(path, f)
+                keepmode(tempname, info)
+            if syncfs is not None:
+                # Flush each filesystem once, instead of each file
+                devices = {}
+                for path, _, _ in changed:
+                    devices.setdefault(stat(dirname(path)).st_dev, dirname(path))
+                for directory in devices.values():
+                    fd = osopen(directory, O_RDONLY)
+                    try:
+                        if syncfs(fd) != 0:
+                            from ctypes import get_errno
+                            raise OSError(get_errno(), "Can't flush the filesystem of " + directory)
+                    finally:
+                        close(fd)
+        except (IOError, OSError):
+            for tempname in temps:
+                try:
+                    remove(tempname)
+                except OSError:
+                    pass
+            raise
+        # Replace the files, and put back the ones that were replaced if one of them fails
+        replaced = []
+        try:
+            for (path, _, _), tempname in zip(changed, temps):
+                replace(tempname, path)
+                replaced.append(path)
+        except (IOError, OSError):
+            for (path, _, original), tempname in zip(changed, temps):
+                if path in replaced:
+                    if original is None:
+                        remove(path)
+                    else:
+                        replacefile(path, lambda f, original=original: f.write(original) and None, self.sync)
+                elif exists(tempname):
+                    remove(tempname)
+            raise
+        if self.sync:
+            for directory in sorted(set([dirname(path) for path in replaced])):
+                syncdir(directory)
+        self.files = {}
+        return replaced
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+class AsyncEditor(object):
+    """Edits files from asyncio code, without blocking the event loop. The files are read,
+    changed and written by the default executor of the loop, with at most limit files
+    being edited at the same time. Edits to the same file are made one at a time, in the
+    order they were awaited. Errors are raised as IOError or OSError.
+    Must be created and used with the same event loop.
+
+    Example:
+        editor = AsyncEditor()
+        await asyncio.gather(*[editor.set(filename, "timeout", "30") for filename in filenames])
+    """
+
+    def __init__(self, limit=32):
+        import asyncio
+        self.semaphore = asyncio.Semaphore(limit)
+        # The lock and the number of waiting edits, for each file that is being edited
+        self.locks = {}
+
+    async def batch(self, filename, edits, sync=False):
+        """Apply many edits to a file, see editfile. Returns True if the file was changed."""
+        import asyncio
+        path = realpath(filename)
+        entry = self.locks.get(path)
+        if entry is None:
+            entry = self.locks[path] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.semaphore:
+                    return await running_loop().run_in_executor(None, editfile, filename, edits, sync)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[path]
+
+    async def set(self, filename, key, value, sync=False):
+        """Set the value for the given key. Returns True if the file was changed."""
+        return await self.batch(filename, [("set", key, value)], sync)
+
+
+# The AsyncEditor for each event loop, for aset and abatch
+ASYNC_EDITORS = {}
+
+
+def running_loop():
+    """Return the running event loop. Python 3.6 does not have get_running_loop,
+    but get_event_loop returns the running loop when called from a coroutine."""
+    import asyncio
+    return getattr(asyncio, "get_running_loop", asyncio.get_event_loop)()
+
+
+def async_editor():
+    """Return the AsyncEditor for the running event loop, creating it if needed"""
+    loop = running_loop()
+    editor = ASYNC_EDITORS.get(loop)
+    if editor is None:
+        # Forget the editors for loops that have been closed
+        for closed in [other for other in ASYNC_EDITORS if other.is_closed()]:
+            del ASYNC_EDITORS[closed]
+        editor = ASYNC_EDITORS[loop] = AsyncEditor()
+    return editor
+
+
+async def aset(filename, key, value, sync=False):
+    """Set the value for the given key in a file, from asyncio code, see AsyncEditor.
+    Returns True if the file was changed."""
+    return await async_editor().set(filename, key, value, sync)
+
+
+async def abatch(filename, edits, sync=False):
+    """Apply many edits to a file, from asyncio code, see AsyncEditor and parse_edit.
+    Returns True if the file was changed."""
+    return await async_editor().batch(filename, edits, sync)
+
+
+def changefile_batch(filename, edits, dummyrun=False, sync=False):
+    """Apply many edits to a file, with one read and one write.
+    if dummyrun==True, don't write but return True if changes would have been made"""
+
     # Read the file
-    with open(filename, 'rb') as f:
-        newcontent = f.read().split(NL)[:-1]
-    # Do the tests
-    passes = True
-    passes = passes and newcontent == testcontent_changed.split(NL)[:-1]
-    print("Changefile and uncomment passes: %s" % (passes))
-    return passes
-
-
-def test_changefile_uncomment_kernel():
-    # Test data
-    testcontent = b"""# CONFIG_KERNEL_XZ is not set
-"""
-    testcontent_changed = b"""CONFIG_KERNEL_XZ=y
-"""
-    filename = mkstemp()[1]
-    # Write the testfile
-    with open(filename, 'wb') as f:
-        f.write(testcontent)
-    # Change the file with changefile
-    changefile(filename, "CONFIG_KERNEL_XZ", "y", uncomment_first=True)
+    data = readfile(filename)
+    # Change and write the file
+    changed_contents = change_contents(data, edits)
+    if dummyrun:
+        return data != changed_contents
+    writefile(filename, changed_contents, data, sync)
+
+
+def kconfig_settings(data):
+    """Return the kernel configuration settings in a .config fragment, as a dictionary
+    from keys to lines, in order. If a key is set several times, the last line is used."""
+    settings = {}
+    for line in data.split(NL):
+        line = line.strip()
+        match = KCONFIG_PATTERN.match(line)
+        if match:
+            settings.pop(match.group(1), None)
+            settings[match.group(1)] = line
+    return settings
+
+
+def merge_kconfig(data, settings):
+    """Merge kernel configuration settings, from kconfig_settings, into the contents of a
+    kernel .config, like scripts/kconfig/merge_config.sh does. Lines for keys that are
+    in the settings are replaced where they are, whether the key is set or "is not set",
+    and the settings for keys that are missing are added at the end. This is done in a
+    single pass, so merging m settings into n lines takes O(n + m) time.
+    Returns the merged contents."""
+    if STATS:
+        start = perf_counter()
+    lines, final_nl = splitlines(data)
+    if not data.strip():
+        lines = []
+    merged = set()
+    newlines = []
+    for line in lines:
+        match = KCONFIG_PATTERN.match(line)
+        if match is None or match.group(1) not in settings:
+            newlines.append(line)
+            continue
+        key = match.group(1)
+        if key not in merged:
+            newlines.append(settings[key])
+            merged.add(key)
+        # Later lines for the same key are removed
+    missing = [line for key, line in settings.items() if key not in merged]
+    if STATS:
+        STATS.timed("change", start)
+        STATS.lines(len(lines), 0, len(merged))
+    if not newlines and not missing:
+        return data
+    return NL.join(newlines + missing) + (NL if final_nl or missing else b"")
+
+
+def mergefile(filename, fragments, dummyrun=False, sync=False):
+    """Merge one or more kernel .config fragments into a kernel .config, see merge_kconfig.
+    When fragments set the same key, the last one is used.
+    if dummyrun==True, don't write but return True if changes would have been made"""
+    settings = {}
+    for fragment in fragments:
+        for key, line in kconfig_settings(readfile(fragment)).items():
+            settings.pop(key, None)
+            settings[key] = line
     # Read the file
-    with open(filename, 'rb') as f:
-        newcontent = f.read().split(NL)[:-1]
-    # Do the tests
-    passes = True
-    passes = passes and newcontent == testcontent_changed.split(NL)[:-1]
-    print("Changefile kernel config passes: %s" % (passes))
-    return passes
+    data = readfile(filename)
+    # Change and write the file
+    changed_contents = merge_kconfig(data, settings)
+    if dummyrun:
+        return data != changed_contents
+    writefile(filename, changed_contents, data, sync)
+
+
+def walkdir(directory, include=None):
+    """Yield the paths of all files in a directory and its subdirectories, sorted by name.
+    If include is given, only files with names that match one of the glob patterns are used.
+    Symlinks to directories are not followed."""
+    from fnmatch import fnmatch
+    directories = [directory]
+    while directories:
+        try:
+            entries = sorted(scandir(directories.pop()), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file() and (not include or [p for p in include if fnmatch(entry.name, p)]):
+                yield entry.path
+        directories += reversed(subdirectories)
+
+
+def findfiles(paths, include=None):
+    """Yield the files for the given filenames, glob patterns and directories.
+    Directories are searched recursively, see walkdir."""
+    from glob import glob
+    for path in paths:
+        if [c for c in "*?[" if c in path]:
+            found = sorted(glob(path, recursive=True))
+        else:
+            found = [path]
+        for filename in found:
+            if isdir(filename):
+                for walked in walkdir(filename, include):
+                    yield walked
+            else:
+                yield filename
+
+
+def prefilter_keys(edits):
+    """Return the keys that a file must contain for the edits to change it,
+    or None if the edits may change any file."""
+    keys = []
+    for edit in edits:
+        if edit[0] == "add":
+            return None
+        keys.append(bs(edit[1]).strip())
+    return keys
+
+
+def changefile_job(job):
+    """Apply edits to one file, for changefiles. Returns the filename and
+    "changed", "unchanged", "skipped" or an error message."""
+    filename, edits, keys, sync, dialect = job
+    previous = DIALECT
+    try:
+        data = loadfile(filename)
+        if dialect is not None:
+            use_dialect(detect_dialect(filename, data) if dialect == "auto" else dialect)
+        # Skip files that can not contain any of the keys, without parsing them
+        if keys is not None and not [key for key in keys if key in data]:
+            return filename, "skipped"
+        changed_contents = change_contents(data, edits)
+        if changed_contents == data:
+            return filename, "unchanged"
+        savefile(filename, changed_contents, data, sync)
+        return filename, "changed"
+    except (IOError, OSError) as e:
+        return filename, "error: %s" % (e)
+    finally:
+        use_dialect(previous)
+
+
+def runjobs(function, jobs, processes=None):
+    """Yield the results of calling function for each job, in order. The jobs are run by
+    a pool of processes, one per CPU if processes is not given."""
+    if processes == 1:
+        for job in jobs:
+            yield function(job)
+        return
+    from multiprocessing import Pool
+    pool = Pool(processes)
+    try:
+        for result in pool.imap(function, jobs, 16):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def changefiles(paths, edits, include=None, processes=None, sync=False, dialect=None):
+    """Apply the same edits to many files, found by findfiles. Files that do not contain
+    any of the keys are skipped without being parsed. The files are changed by a pool of
+    processes, one per CPU if processes is not given. The dialect is a dialect name or
+    "auto" for detect_dialect, see use_dialect. Yields the filename and the status for
+    each file, see changefile_job."""
+    keys = prefilter_keys(edits)
+    jobs = ((filename, edits, keys, sync, dialect) for filename in findfiles(paths, include))
+    return runjobs(changefile_job, jobs, processes)
+
+
+def getfile_job(job):
+    """Read values from one file, for getfiles. Returns the filename, the values
+    and None, or the filename, None and an error message."""
+    filename, keys, dialect = job
+    previous = DIALECT
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if dialect is not None:
+            use_dialect(detect_dialect(filename, data) if dialect == "auto" else dialect)
+        return filename, get_values(data, keys), None
+    except (IOError, OSError) as e:
+        return filename, None, str(e)
+    finally:
+        use_dialect(previous)
+
+
+def getfiles(paths, keys=None, include=None, processes=None, dialect=None):
+    """Read the values for the given keys, or for all keys if keys is None, from many
+    files, found by findfiles. The dialect is given as for changefiles. Yields the filename,
+    the values and an error message for each file, see getfile_job and get_values."""
+    jobs = ((filename, keys, dialect) for filename in findfiles(paths, include))
+    return runjobs(getfile_job, jobs, processes)
+
+
+def printvalues(values, keys=None, filename=None, null=False):
+    """Print the values from get_values as JSON, or as NUL separated fields if null is True.
+    Keys that were asked for but not found are null in the JSON output and left out in
+    the NUL separated output. If a filename is given, the JSON object has the filename
+    and the values, and each NUL separated key and value is preceded by the filename.
+    A key that is asked for more than once is only printed once."""
+    from collections import OrderedDict
+    keys = list(values) if keys is None else list(OrderedDict.fromkeys([bs(key).strip() for key in keys]))
+    if null:
+        fields = []
+        for key in keys:
+            if key in values:
+                fields += [key, values[key]] if filename is None else [bs(filename), key, values[key]]
+        stdout.flush()
+        stdout.buffer.write(b"".join([field + b"\0" for field in fields]))
+        stdout.buffer.flush()
+        return
+    from json import dumps
+
+    def text(b):
+        return b.decode("utf-8", "surrogateescape")
+
+    # Keep the order of the keys
+    obj = OrderedDict([(text(key), text(values[key]) if key in values else None) for key in keys])
+    if filename is not None:
+        obj = OrderedDict([("filename", filename), ("values", obj)])
+    print(dumps(obj))
 
 
 def change_multiline(data, key, value, endstring=NL, verbose=True, searchfrom=0, define=False):
@@ -433,302 +2141,136 @@ def change_multiline(data, key, value, endstring=NL, verbose=True, searchfrom=0,
     value = bs(value)
     endstring = bs(endstring)
 
-    if key not in data:
+    startpos = data.find(key, searchfrom)
+    if startpos == -1:
         return data
     # If the endstring marker ends with '$', use a newline instead
     if endstring.endswith(b'$'):
         endstring = endstring[:-1] + b'\n'
     # Check if the endstring exists in the data
-    if (endstring != NL) and (endstring not in data):
+    has_endstring = data.find(endstring) != -1
+    if (endstring != NL) and not has_endstring:
         if verbose:
             print("Multiline end marker not found: " + str(endstring))
         return data
-    startpos = data.find(key, searchfrom)
-    if endstring in data:
-        endpos = data.find(endstring, startpos + 1)
-    else:
-        endpos = len(data) - 1
-    before = data[:startpos]
-    between = data[startpos:endpos + 1]
-
-    linestartpos = data[:startpos].rfind(NL) + 1
-    line = data[linestartpos:endpos + 1]
-
-    # If the first part of the line is not a key (could be because it's commented out)...
-    if not firstpart(line):
+    # Search forward until the key is found at the start of a line that is not commented out
+    while True:
+        if has_endstring:
+            endpos = data.find(endstring, startpos + 1)
+            if endpos == -1:
+                return data
+        else:
+            endpos = len(data) - 1
+        linestartpos = data.rfind(NL, 0, startpos) + 1
+        # If the first part of the line is a key, this is the value to change
+        if firstpart(data[linestartpos:endpos + 1]):
+            break
         # Search again, from endpos this time
-        return change_multiline(data, key, value, endstring, verbose, endpos, define=define)
+        startpos = data.find(key, max(endpos, startpos + 1))
+        if startpos == -1:
+            return data
 
-    after = data[endpos + len(endstring):]
+    if STATS:
+        STATS.matches += 1
+    between = data[startpos:endpos + 1]
     newbetween = changeline(between, value)
 
     if between.endswith(NL) or (NL in between and endstring.endswith(NL)):
         newbetween += NL
 
-    result = before + newbetween + after
-    return result
-
-
-def test_change_multiline():
-    passes = True
-    # test 1
-    testcontent = b"keys := missing" + NL + b"dog = found" + NL * 3
-    testcontent_changed = b"keys := found" + NL + b"dog = found" + NL * 3
-    a = change_multiline(testcontent, "keys", "found")
-    b = testcontent_changed
-    extracheck = testcontent.replace(b"missing", b"found") == testcontent_changed
-    passes = passes and a == b and extracheck
-    if not passes:
-        print("FAIL1")
-    # test 2
-    testcontent = bs('blabla\nOST=(a\nb)\n\nblabla\nÆØÅ')
-    testcontent_changed = bs('blabla\nOST=(c d)\n\nblabla\nÆØÅ')
-    a = change_multiline(testcontent, "OST", "(c d)", ")")
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL2")
-    # test 3
-    testcontent = bs('bläblä=1')
-    testcontent_changed = bs('bläblä=2')
-    a = change_multiline(testcontent, "bläblä", "2")
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL3")
-    # test 4
-    testcontent = b"\n"
-    testcontent_changed = b"\n"
-    a = change_multiline(testcontent, "blablañ", "ost")
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL4")
-    # test 5
-    testcontent = b""
-    testcontent_changed = b""
-    a = change_multiline(testcontent, "blabla", "ost")
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL5")
-    # test 6
-    testcontent = b"a=(1, 2, 3"
-    testcontent_changed = b"a=(1, 2, 3"
-    a = change_multiline(testcontent, "a", "(4, 5, 6)", ")", verbose=False)
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL6")
-    # test 7
-    testcontent = b"a=(1, 2, 3\nb=(7, 8, 9)"
-    testcontent_changed = b"a=(4, 5, 6)"
-    a = change_multiline(testcontent, "a", "(4, 5, 6)", ")")
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL7")
-    # test 8
-    testcontent = b"a=(0, 0, 0)\nb=(1\n2\n3\n)\nc=(7, 8, 9)"
-    testcontent_changed = b"a=(0, 0, 0)\nb=(4, 5, 6)\nc=(7, 8, 9)"
-    a = change_multiline(testcontent, "b", "(4, 5, 6)", ")")
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL8")
-    # test 9
-    testcontent = b"a=(0, 0, 0)\nb=(1\n2\n3\n)\nc=(7, 8, 9)\n\n"
-    testcontent_changed = b"a=(0, 0, 0)\nb=(1\n2\n3\n)\nc=(7, 8, 9)\n\n"
-    a = change_multiline(testcontent, "b", "(4, 5, 6)", "]", verbose=False)
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL9")
-    # test 10
-    testcontent = bs("""
-source=("http://prdownloads.sourceforge.net/maniadrive/ManiaDrive-$pkgver-linux-i386.tar.gz"
-        "maniadrive.desktop"
-        "ñlicense.txt"
-        "https://admin.fedoraproject.org/pkgdb/appicon/show/Maniadrive")
-md5sums=('5592eaf4b8c4012edcd4f0fc6e54c09c'
-         '064639f1b48ec61e46c524ae31eec520'
-         'afa5fac56d01430e904dd6716d84f4bf'
-         '9b5fc9d981d460a7b0c9d78e75c5aeca')
-
-build() {
-  cd "$srcdir/ManiaDrive-$pkgver-linux-i386"
-""")
-    testcontent_changed = bs("""
-source=("http://prdownloads.sourceforge.net/maniadrive/ManiaDrive-$pkgver-linux-i386.tar.gz"
-        "maniadrive.desktop"
-        "ñlicense.txt"
-        "https://admin.fedoraproject.org/pkgdb/appicon/show/Maniadrive")
-md5sums=('123abc' 'abc123')
-
-build() {
-  cd "$srcdir/ManiaDrive-$pkgver-linux-i386"
-""")
-    a = change_multiline(testcontent, "md5sums", "('123abc' 'abc123')", ")", verbose=False)
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL10")
-    # test 11
-    testcontent = b"x=(0, 0, 0)\nCHEESE\nz=2\n"
-    testcontent_changed = b"x=(4, 5, 6)\nz=2\n"
-    a = change_multiline(testcontent, "x", "(4, 5, 6)", "CHEESE", verbose=False)
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL11")
-    # test 12
-    testcontent = b"# md5sum=('abc123')\nmd5sum=('def456')\nmd5sum=('ghi789')\n"
-    testcontent_changed = b"# md5sum=('abc123')\nmd5sum=('OST')\nmd5sum=('ghi789')\n"
-    a = change_multiline(testcontent, "md5sum", "('OST')", "\n", verbose=False)
-    b = testcontent_changed
-    passes = passes and a == b
-    if not passes:
-        print("FAIL12")
-    # result
-    print("Change multiline passes: %s" % (passes))
-    return passes
-
-
-def changefile_multiline(filename, key, value, endstring=b"\n"):
+    view = memoryview(data)
+    return b"".join([view[:startpos], newbetween, view[endpos + len(endstring):]])
+
 
+def keeplines(f):
+    """Yield the lines of an open binary file, with the NL at the end of each line"""
+    previous = None
+    for line in iterlines(f):
+        if previous is not None:
+            yield previous + NL
+        previous = line
+    if previous:
+        yield previous
+
+
+def streammultiline(infile, outfile, key, value, endstring=b"\n"):
+    """Read from infile, change a multiline value and write to outfile, with the same result
+    as change_multiline. Only the contents from the line where the key is found to the end
+    marker are kept in memory, the other lines are written as soon as they are read."""
     key = bs(key)
     value = bs(value)
+    endstring = bs(endstring)
+    marker = endstring[:-1] + b"\n" if endstring.endswith(b"$") else endstring
+    # The contents that are kept, which start at the start of a line, and where to search for the key
+    kept = b""
+    searchfrom = 0
+    written = False
+    lines = keeplines(infile)
+    for line in lines:
+        kept += line
+        while True:
+            startpos = kept.find(key, searchfrom)
+            if startpos == -1:
+                # The key is not in any of the kept lines
+                outfile.write(kept)
+                written = written or len(kept) > 0
+                kept, searchfrom = b"", 0
+                break
+            endpos = kept.find(marker, startpos + 1)
+            if endpos == -1:
+                # Keep the lines until the end marker is found
+                break
+            linestartpos = kept.rfind(NL, 0, startpos) + 1
+            if firstpart(kept[linestartpos:endpos + 1]):
+                # Change the value, then copy the rest
+                outfile.write(change_multiline(kept, key, value, endstring, False, searchfrom))
+                for line in lines:
+                    outfile.write(line)
+                return
+            # Search again from endpos, and write the lines before the line of endpos
+            searchfrom = max(endpos, startpos + 1)
+            linestartpos = kept.rfind(NL, 0, searchfrom) + 1
+            outfile.write(kept[:linestartpos])
+            written = written or linestartpos > 0
+            kept, searchfrom = kept[linestartpos:], searchfrom - linestartpos
+    if kept and (not written or kept.find(marker) != -1):
+        # All of the contents are kept, or the end marker is there, so that the
+        # end marker is found the same way as for all of the contents
+        outfile.write(change_multiline(kept, key, value, endstring, False, searchfrom))
+    else:
+        outfile.write(kept)
 
-    # Read the file
-    try:
-        with open(filename, 'rb') as f:
-            data = f.read()
-    except IOError:
-        print("Can't read %s" % (filename))
-        sysexit(2)
-    # Change and write the file
-    new_contents = change_multiline(data, key, value, endstring)
-    try:
-        with open(filename, 'wb') as f:
-            f.write(new_contents)
-    except:  # UnicodeEncodeError: not supported by shedskin
-        #print("codeEncodeError: Can't change value for %s" % (filename))
-        print("Can't change value for %s" % (filename))
-        sysexit(2)
 
+def changefile_multiline(filename, key, value, endstring=b"\n", sync=False):
+    """Change a value that may span several lines, up to the end string, see change_multiline.
+    If the filename is "-", stdin is changed and written to stdout instead, see streammultiline."""
+
+    key = bs(key)
+    value = bs(value)
+
+    if filename == "-" and CHECK is None:
+        streammultiline(stdin.buffer, stdout.buffer, key, value, endstring)
+        stdout.buffer.flush()
+        return
 
-def test_changefile_multiline():
-    # Test data
-    testcontent = b"keys := missing" + NL + b"dog = found" + NL * 3 + bs("æøåÆØÅ")
-    testcontent_changed = b"keys := found" + NL + b"dog = missing" + NL * 3 + bs("æøåÆØÅ")
-    filename = mkstemp()[1]
-    # Write the testfile
-    with open(filename, 'wb') as f:
-        f.write(testcontent)
-    # Change the file with changefile
-    changefile_multiline(filename, "keys", "found")
-    changefile_multiline(filename, "dog", "missing")
-    # Read the file
-    with open(filename, 'rb') as f:
-        newcontent = f.read()
-    # Do the tests
-    passes = True
-    passes = passes and newcontent == testcontent_changed
-    print("Changefile multiline passes: %s" % (passes))
-    return passes
-
-# Note that this test function may cause sysexit to be called if it fails
-# because it calls the main function directly
-
-
-def test_addline():
-    # --- TEST 1 ---
-    testcontent = b"# cache-ttl=65000" + NL + b"MOO=yes" + NL
-    testcontent_changed = b"# cache-ttl=65000" + NL + b"MOO=no" + NL + \
-        b"X=123" + NL + b"Y=345" + NL + b"Z:=567" + NL + \
-        b"FJORD => 999" + NL + b'vm.swappiness=1' + \
-        NL + b"cache-ttl=6" + NL
-    filename = mkstemp()[1]
-    # Write the testfile
-    with open(filename, 'wb') as f:
-        f.write(testcontent)
-    # Change the file by adding keys and values
-    main(["-a", filename, "X", "123"])
-    main(["--add", filename, "Y=345"])
-    main(["-a", filename, "Z:=567"])
-    main(["--add", filename, "FJORD => 999"])
-    main(["--add", filename, "MOO", "no"])
-    main(["-a", filename, "vm.swappiness=1"])
-    main(["-a", filename, "vm.swappiness=1"])
-    main(["-a", filename, "cache-ttl=6"])
-    # Read the file
-    with open(filename, 'rb') as f:
-        newcontent = f.read()
-
-    # --- TEST 2 ---
-    testcontent_changed2 = b"x=2" + NL
-    filename = mkstemp()[1]
-    # Write an empty testfile
-    open(filename, 'wb+').close()
-    # Change the file by adding keys and values
-    main(["-a", filename, "x=2"])
-    # Read the file
-    with open(filename, 'rb') as f:
-        newcontent2 = f.read()
-
-    # Do the tests
-    passes = True
-    passes = passes and (newcontent == testcontent_changed)
-    passes = passes and (newcontent2 == testcontent_changed2)
-
-    print("Addline passes: %s" % (passes))
-    return passes
-
-
-def test_latin1():
-    # Test data
-    testcontent = b64decode(
-        b"SGVsbG8sIHRoaXMgaXMgYW4gSVNPLTg4NTktMSBlbmNvZGVkIHRleHQgZmlsZS4gQmzlYuZyIG9n\nIHL4ZHZpbi4KCkFsc28sCng9Nwo=")
-    testcontent_changed = b64decode(
-        b"SGVsbG8sIHRoaXMgaXMgYW4gSVNPLTg4NTktMSBlbmNvZGVkIHRleHQgZmlsZS4gQmzlYuZyIG9n\nIHL4ZHZpbi4KCkFsc28sCng9NDIK")
-
-    filename = mkstemp()[1]
-    # Write the testfile
-    with open(filename, 'wb') as f:
-        f.write(testcontent)  # already bytes, no need to encode
-    # Change the file with changefile
-    changefile(filename, "x", "42")
     # Read the file
-    with open(filename, 'rb') as f:
-        newcontent = f.read().split(NL)[:-1]
-    # Do the tests
-    passes = True
-    passes = passes and newcontent == testcontent_changed.split(NL)[:-1]
-    print("ISO-8859-1 passes: %s" % (passes))
-    return passes
-
-
-def tests():
-    # If one test fails, the rest will not be run
-    passes = True
-    passes = passes and test_changeline()
-    passes = passes and test_change()
-    passes = passes and test_change_define()
-    passes = passes and test_changefile()
-    passes = passes and test_change_multiline()
-    passes = passes and test_changefile_multiline()
-    passes = passes and test_addline()
-    passes = passes and test_latin1()
-    passes = passes and test_uncomment()
-    passes = passes and test_changefile_uncomment()
-    passes = passes and test_changefile_uncomment_kernel()
-    if passes:
-        print("All tests pass!")
-    else:
-        print("Tests fail.")
+    data = readfile(filename)
+    # Change and write the file
+    if STATS:
+        start = perf_counter()
+    new_contents = change_multiline(data, key, value, endstring)
+    if STATS:
+        STATS.timed("change", start)
+    writefile(filename, new_contents, data, sync)
 
 
 def create_if_missing(filename):
+    if filename == "-":
+        # stdin is never missing
+        return
+    if CHECK is not None:
+        CHECK.create(filename)
+        return
     if not exists(filename):
         try:
             open(filename, 'wb').close()
@@ -739,39 +2281,61 @@ def create_if_missing(filename):
 
 def has_key(data, key):
     """Check if the given key exists in the given data."""
-    lines = data.split(NL)[:-1]
-    for line in lines:
-        if not line.strip():
-            # Skip blank lines
-            continue
-        first = firstpart(line, False)
-        if key == first:
+    key = bs(key).strip()
+    if not key or NL in key:
+        return False
+    for line in keylines(data, key):
+        found, _, _ = splitassignment(line)
+        if found is not None and found.strip() == key:
             return True
     return False
 
 
-def get_value(data, key):
-    """Return the first value for a given key."""
-    lines = data.split(NL)[:-1]
-    for line in lines:
-        if not line.strip():
-            # Skip blank lines
+def get_value(data, key, nth=1):
+    """Return the first value for a given key, or the value of the n'th occurrence.
+    Only the lines that contain the key are parsed, up to the line that is found."""
+    key = bs(key).strip()
+    if not key or NL in key:
+        return b""
+    for line in keylines(data, key):
+        found, _, value = splitassignment(line)
+        if found is None or found.strip() != key:
             continue
-        first, second = parts(line, False)
-        if first:
-            first = first.strip()
-        if second:
-            second = second.strip()
-        if key == first:
-            return second
+        nth -= 1
+        if not nth:
+            if value:
+                value = value.strip()
+            return value
     return b""
 
 
+def get_values(data, keys=None):
+    """Return a dictionary with the values for the given keys, in a single pass over the
+    lines. The first value for each key is used, like get_value does. Keys that are not
+    found are left out. If keys is None, the values for all keys are returned."""
+    wanted = None if keys is None else set([bs(key).strip() for key in keys])
+    values = {}
+    if wanted is not None and not [key for key in wanted if key in data]:
+        return values
+    for line in data.split(NL):
+        key, _, value = splitassignment(line)
+        if key is None:
+            continue
+        key = key.strip()
+        if not key or key in values or (wanted is not None and key not in wanted):
+            continue
+        values[key] = value.strip()
+        if wanted is not None and len(values) == len(wanted):
+            break
+    return values
+
+
 def strip_trailing_zeros(s):
     return s.rstrip(b'0').rstrip(b'.') if b'.' in s else s
 
 
 def byte2decimal(b):
+    from decimal import Decimal
     return Decimal(b.decode("utf-8", "ignore"))
 
 
@@ -797,9 +2361,453 @@ def dec(startvalue, s):
     return strip_trailing_zeros(result)
 
 
+def default_socket():
+    """Return the path of the Unix socket for the daemon, from $SETCONF_SOCKET
+    or in $XDG_RUNTIME_DIR or /tmp. The same as in setconf_client."""
+    from os import getuid
+    if environ.get("SETCONF_SOCKET"):
+        return environ["SETCONF_SOCKET"]
+    return join(environ.get("XDG_RUNTIME_DIR") or "/tmp", "setconf-%d.sock" % (getuid()))
+
+
+def filestamp(info):
+    """Return what is used for checking if a file was changed, from the result of stat"""
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+def removestale(socketpath):
+    """Remove the socket of a daemon that is no longer running. Raises OSError if there is
+    something else at the path, or if a daemon is still listening there."""
+    from os import lstat
+    from socket import AF_UNIX, SOCK_STREAM, socket
+    from stat import S_ISSOCK
+    try:
+        info = lstat(socketpath)
+    except OSError:
+        return
+    if not S_ISSOCK(info.st_mode):
+        raise OSError("Not a socket, and will not be replaced: %s" % (socketpath))
+    s = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        s.connect(socketpath)
+    except (IOError, OSError):
+        remove(socketpath)
+        return
+    finally:
+        s.close()
+    raise OSError("A daemon is already listening on %s" % (socketpath))
+
+
+def make_daemon(socketpath, cachesize=256):
+    """Return a server that listens on a Unix socket and runs setconf commands sent by
+    setconf_client. Up to cachesize files are kept in memory, split into lines, and are
+    only read again if the inode, size or mtime changes. Changes to the same file are
+    made one at a time. Call serve_forever() on the returned server to start it.
+    Raises OSError if the socket can not be made, see removestale."""
+    from collections import OrderedDict
+    from json import dumps, loads
+    from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+    from threading import Lock
+
+    cache = OrderedDict()
+    cachelock = Lock()
+    # Changes to the same file are serialized by one of these locks
+    filelocks = [Lock() for _ in range(64)]
+
+    def store(filename, stamp, data):
+        """Split the contents into lines and keep them, evicting the least recently used file"""
+        lines, final_nl = splitlines(data)
+        entry = (stamp, data, lines, final_nl, lineoffsets(lines))
+        with cachelock:
+            cache[filename] = entry
+            cache.move_to_end(filename)
+            while len(cache) > cachesize:
+                cache.popitem(last=False)
+        return entry
+
+    def cached(filename):
+        """Return the cached contents of a file, reading it again if it has changed"""
+        stamp = filestamp(stat(filename))
+        with cachelock:
+            entry = cache.get(filename)
+            if entry is not None and entry[0] == stamp:
+                cache.move_to_end(filename)
+                return entry
+        with open(filename, 'rb') as f:
+            return store(filename, stamp, f.read())
+
+    def change(filename, edits, multiline, sync):
+        """Change a file, using the cached contents. Returns the exit status and the output."""
+        try:
+            if [edit for edit in edits if edit[0] == "add"] and not exists(filename):
+                open(filename, 'wb').close()
+            _, data, lines, final_nl, offsets = cached(filename)
+        except (IOError, OSError):
+            return 2, "Can't read %s" % (filename)
+        if multiline:
+            changed_contents = change_multiline(data, multiline[0], multiline[1], multiline[2], verbose=False)
+        else:
+            changed_contents = change_lines(data, lines, final_nl, offsets, edits)
+        if changed_contents == data:
+            return 0, ""
+        stamps = []
+
+        def write(f):
+            f.write(changed_contents)
+            f.flush()
+            stamps.append(filestamp(fstat(f.fileno())))
+
+        try:
+            replacefile(filename, write, sync)
+        except (IOError, OSError):
+            with cachelock:
+                cache.pop(filename, None)
+            return 2, "No write permission: %s" % (filename)
+        store(filename, stamps[-1], changed_contents)
+        return 0, ""
+
+    def run(args, cwd):
+        """Run a setconf command. Returns the exit status and the output. The status is None
+        if the daemon can not run the command, so that the client runs setconf instead."""
+        if len(args) == 1 and args[0] in ["-v", "--version"]:
+            return 0, VERSION
+        try:
+            options, flag_args, parsed_args = parse_args(args)
+        except SystemExit:
+            return None, "Invalid arguments"
+        unsupported = ["multiple", "stream", "nth", "stats", "merge", "get", "after", "dialect", "transaction",
+                       "check", "diff", "watch"]
+        if [name for name in unsupported if options[name]] or parsed_args[:1] in [[], ["-"]]:
+            return None, "Not supported by the daemon"
+        # The cache and the locks are for the real path, so that all the paths to a file share them
+        filename = realpath(join(cwd, parsed_args[0]))
+        rest = parsed_args[1:]
+        multiline = None
+        if options["batch"] and rest == ["-"]:
+            # The edits are read from the stdin of the client
+            return None, "Not supported by the daemon"
+        if options["batch"] and len(rest) == 1:
+            try:
+                with open(join(cwd, rest[0]), 'rb') as f:
+                    edits = parse_edits(f.read().decode("utf-8"))
+            except (IOError, OSError, UnicodeDecodeError):
+                return 2, "Can't read %s" % (rest[0])
+            except ValueError as e:
+                return 2, "%s in %s" % (e, rest[0])
+        elif options["batch"]:
+            edits = batch_edits(rest, flag_args)
+        elif len(rest) == 3:
+            multiline = [bs(arg) for arg in rest]
+            edits = []
+        elif len(rest) in [1, 2]:
+            edits = [parse_edit(flag_args + rest)]
+        else:
+            return None, "Not supported by the daemon"
+        if edits is None or None in edits:
+            return None, "Not supported by the daemon"
+        with filelocks[hash(filename) % len(filelocks)]:
+            return change(filename, edits, multiline, options["sync"])
+
+    class Handler(StreamRequestHandler):
+
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = loads(line.decode("utf-8"))
+                    args, cwd = request["args"], request["cwd"]
+                    if not isinstance(cwd, str) or not isinstance(args, list) or \
+                            [arg for arg in args if not isinstance(arg, str)]:
+                        raise ValueError("The arguments must be strings")
+                except (KeyError, TypeError, ValueError) as e:
+                    status, output = 2, "Invalid request: %s" % (e)
+                else:
+                    status, output = run(args, cwd)
+                self.wfile.write(dumps({"status": status, "output": output}).encode("utf-8") + b"\n")
+
+    removestale(socketpath)
+    # Only the owner may connect to the socket
+    mode = umask(0o177)
+    try:
+        server = ThreadingUnixStreamServer(socketpath, Handler)
+    finally:
+        umask(mode)
+    server.daemon_threads = True
+    return server
+
+
+def serve(socketpath=None, cachesize=256):
+    """Run the daemon until it is interrupted, see make_daemon"""
+    socketpath = socketpath or default_socket()
+    try:
+        server = make_daemon(socketpath, cachesize)
+    except (IOError, OSError) as e:
+        print("Can't start the daemon: %s" % (e))
+        sysexit(2)
+    print("Listening on %s" % (socketpath))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        remove(socketpath)
+
+
+# Flags from <sys/inotify.h>, for watch
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+IN_CLOEXEC = 0o2000000
+
+
+def filesignature(filename):
+    """Return what changes when a file is written or replaced, or None if it is missing"""
+    try:
+        return filestamp(stat(filename))
+    except OSError:
+        return None
+
+
+def watch(filenames, apply, delay=0.1):
+    """Call apply with a list of all the given files, then again with the files that have
+    changed, each time some of them are written or replaced by something else. Uses inotify
+    on Linux, through ctypes, so nothing is done while the files are left alone. The
+    directories of the files are watched, since files are often replaced by renaming.
+    Events are collected until there have been none for delay seconds, so that a burst of
+    writes is handled at once. Files that apply replaces are not applied again, unless
+    something else writes them afterwards, since the signatures of the replaced files are
+    taken from the temporary files that apply wrote. The signatures of the other files are
+    taken before apply reads them. Stops when apply returns False.
+    Raises OSError if inotify can not be used."""
+    from ctypes import CDLL, get_errno
+    from os import read as osread
+    from select import select
+    from struct import calcsize, unpack_from
+    try:
+        libc = CDLL(None, use_errno=True)
+        init, addwatch = libc.inotify_init1, libc.inotify_add_watch
+    except (AttributeError, OSError):
+        raise OSError("inotify is not available")
+    fd = init(IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(get_errno(), "Can't use inotify")
+    try:
+        # The filenames by directory and name, and the directories by watch descriptor
+        names = {}
+        for filename in filenames:
+            path = realpath(filename)
+            names.setdefault(dirname(path), {})[basename(path)] = filename
+        directories = {}
+        for directory in names:
+            wd = addwatch(fd, bs(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                raise OSError(get_errno(), "Can't watch " + directory)
+            directories[wd] = directory
+
+        def changes(timeout):
+            """Return the watched files that had events, or None if there were none in time"""
+            if not select([fd], [], [], timeout)[0]:
+                return None
+            data = osread(fd, 65536)
+            found = set()
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = unpack_from("iIII", data, pos)
+                pos += calcsize("iIII")
+                name = data[pos:pos + length].rstrip(b"\0").decode("utf-8", "surrogateescape")
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost
+                    found.update(filenames)
+                elif wd in directories:
+                    filename = names[directories[wd]].get(name)
+                    if filename is not None:
+                        found.add(filename)
+            return found
+
+        signatures = {}
+
+        def run(changed):
+            """Call apply, and keep the signatures of the files for when it is done"""
+            global WRITTEN
+            before = dict([(filename, filesignature(filename)) for filename in changed])
+            previous, WRITTEN = WRITTEN, {}
+            try:
+                return apply(changed)
+            finally:
+                for filename in changed:
+                    signatures[filename] = WRITTEN.get(realpath(filename), before[filename])
+                WRITTEN = previous
+
+        filenames = list(filenames)
+        if run(filenames) is False:
+            return
+        while True:
+            changed = changes(None)
+            more = changes(delay)
+            while more is not None:
+                changed.update(more)
+                more = changes(delay)
+            changed = [filename for filename in filenames
+                       if filename in changed and filesignature(filename) != signatures[filename]]
+            if not changed:
+                continue
+            if run(changed) is False:
+                return
+    finally:
+        close(fd)
+
+
+def watchfiles(filenames, run):
+    """Call run with the files that have changed, first with all of them, and then each time
+    some of them are changed by something else, until interrupted, see watch. Errors from
+    run, like files that can not be read, are printed by run and then ignored, except for
+    invalid arguments the first time. Exits with an error message if inotify can not be used."""
+    first = [True]
+
+    def apply(changed):
+        try:
+            run(changed)
+        except SystemExit as e:
+            if first[0] and e.code == 1:
+                raise
+        first[0] = False
+
+    try:
+        watch(filenames, apply)
+    except OSError as e:
+        print("Can't watch the files: %s" % (e))
+        sysexit(2)
+    except KeyboardInterrupt:
+        pass
+
+
+def optionvalue(arg, args):
+    """Return the value for an option that is given as --option=value,
+    or remove and return the next argument."""
+    if arg.startswith("--") and "=" in arg:
+        return arg.split("=", 1)[1]
+    if args:
+        return args.pop(0)
+    return ""
+
+
+def positive_number(arg, value):
+    """Return the given value as a positive number, or exit with an error message."""
+    if not value.isdigit() or int(value) < 1:
+        print("The value for %s must be a positive number" % (arg))
+        sysexit(2)
+    return int(value)
+
+
+def batch_edits(args, flag_args):
+    """Return the edits for batch mode, from an edits file or from key/value pairs,
+    or None if the arguments can not be used."""
+    if len(args) == 1:
+        return read_edits(args[0])
+    if not args or len(args) % 2 == 1:
+        return None
+    edits = []
+    for i in range(0, len(args), 2):
+        edits.append(parse_edit(flag_args + args[i:i + 2]))
+    return edits
+
+
+def parse_args(args):
+    """Parse the command line arguments for changing files. Returns a dictionary with the
+    options, the flags that select the kind of change and the rest of the arguments."""
+    options = {"define": False, "add": False, "uncomment": False, "batch": False, "stream": False,
+               "sync": False, "multiple": False, "merge": False, "get": None, "null": False, "nth": 0,
+               "jobs": None, "include": [], "after": None, "stats": None, "cache": environ.get("SETCONF_CACHE") or None,
+               "cache_size": CACHE_SIZE, "dialect": None,
+               "transaction": None, "check": False, "diff": False, "watch": False}
+    flag_args = []
+    parsed_args = []
+    # The number of arguments before the filename
+    options["optionargs"] = len(args)
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if parsed_args and arg not in ["-d", "--define", "-a", "--add", "-u", "--uncomment"]:
+            # Only the flags that setconf has always had are recognized after the filename,
+            # so that values like -s or -j for a key are changed as before
+            parsed_args.append(arg)
+
+        elif arg in ["-n", "--nth"] or arg.startswith("--nth="):
+            # Only change the n'th occurrence of the key
+            options["nth"] = positive_number(arg, optionvalue(arg, args))
+        elif arg in ["-j", "--jobs"] or arg.startswith("--jobs="):
+            options["jobs"] = positive_number(arg, optionvalue(arg, args))
+        elif arg == "--include" or arg.startswith("--include="):
+            options["include"].append(optionvalue(arg, args))
+        elif arg == "--dialect" or arg.startswith("--dialect="):
+            options["dialect"] = optionvalue(arg, args)
+            if options["dialect"] != "auto" and options["dialect"] not in DIALECTS:
+                print("The dialect must be auto or one of: " + ", ".join(sorted(DIALECTS)))
+                sysexit(2)
+        elif arg == "--transaction" or arg.startswith("--transaction="):
+            options["transaction"] = optionvalue(arg, args)
+        elif arg == "--after" or arg.startswith("--after="):
+            options["after"] = bs(optionvalue(arg, args))
+        elif arg == "-m" or arg == "--multiple":
+            options["multiple"] = True
+        elif arg == "--merge":
+            options["merge"] = True
+        elif arg == "--get" or arg == "--get-all":
+            options["get"] = arg
+        elif arg == "-0" or arg == "--null":
+            options["null"] = True
+        elif arg == "-d" or arg == "--define":
+            options["define"] = True
+            flag_args.append(arg)
+        elif arg == "-a" or arg == "--add":
+            options["add"] = True
+            flag_args.append(arg)
+        elif arg == "-u" or arg == "--uncomment":
+            options["uncomment"] = True
+            flag_args.append(arg)
+        elif arg == "-b" or arg == "--batch":
+            options["batch"] = True
+        elif arg == "-s" or arg == "--stream":
+            options["stream"] = True
+        elif arg == "--sync":
+            options["sync"] = True
+        elif arg == "--check":
+            options["check"] = True
+        elif arg == "--diff":
+            options["diff"] = True
+        elif arg == "--watch":
+            options["watch"] = True
+        elif arg == "--cache" or arg.startswith("--cache="):
+            # The directory is optional, and can only be given as --cache=DIR
+            options["cache"] = arg.split("=", 1)[1] if "=" in arg else ""
+        elif arg == "--cache-size" or arg.startswith("--cache-size="):
+            options["cache_size"] = positive_number(arg, optionvalue(arg, args)) * 1024 * 1024
+        elif arg == "--no-cache":
+            options["cache"] = False
+        elif arg == "--stats" or arg.startswith("--stats="):
+            options["stats"] = arg.split("=", 1)[1] if "=" in arg else "text"
+            if options["stats"] not in ["text", "json"]:
+                print("The format for --stats must be text or json")
+                sysexit(2)
+        else:
+            if not parsed_args:
+                options["optionargs"] -= len(args) + 1
+            parsed_args.append(arg)
+    return options, flag_args, parsed_args
+
+
 def main(args=argv[1:]):
+    if args and args[0] == "--daemon":
+        # Keep files in memory and change them when asked to by setconf_client
+        if len(args) > 2:
+            sysexit(1)
+        serve(args[1] if len(args) == 2 else None)
+        return
     if len(args) == 1:
         if args[0] in ["-t", "--test"]:
+            # The tests are kept in a separate module, so that they are not loaded otherwise
+            from setconf_tests import tests
             tests()
         elif args[0] in ["-h", "--help"]:
             print("setconf " + VERSION)
@@ -809,14 +2817,55 @@ def main(args=argv[1:]):
             print("Syntax:")
             print("\tsetconf filename key value [end string for multiline value]")
             print("")
+            print("If the filename is -, stdin is changed and written to stdout.")
+            print("Options are given before the filename, except for -a, -d and -u.")
+            print("")
             print("Options:")
             print("\t-h or --help\t\tthis text")
             print("\t-t or --test\t\tinternal self test")
             print("\t-v or --version\t\tversion number")
             print("\t-a or --add\t\tadd the option if it doesn't exist")
             print("\t\t\t\tcreates the file if needed")
-            print("\t-d or --define\t\tset a #define")
+            print("\t--after STRING\t\tfor -a, add the option after the first line")
+            print("\t\t\t\tthat contains the string, if there is one")
+            print("\t-d or --define\t\tset a #define or %define")
             print("\t-u or --uncomment\tuncomment the line first")
+            print("\t-n or --nth N\t\tonly change the n'th occurrence of the key")
+            print("\t-b or --batch\t\tmake many changes to a file at once,")
+            print("\t\t\t\tgiven as key/value pairs or by an edits file")
+            print("\t-s or --stream\t\tread and write one line at a time,")
+            print("\t\t\t\tfor very large files")
+            print("\t--sync\t\t\tflush the changed file to disk")
+            print("\t--check\t\t\tdo not write, exit with 1 if files would")
+            print("\t\t\t\tbe changed and 0 if not")
+            print("\t--diff\t\t\tdo not write, print a unified diff instead")
+            print("\t--stats[=json]\t\twrite timings, counters and peak memory")
+            print("\t\t\t\tto stderr, as text or JSON")
+            print("\t-m or --multiple\tchange many files, directories or globs,")
+            print("\t\t\t\tgiven before -- and the key and value")
+            print("\t-j or --jobs N\t\tthe number of processes for -m")
+            print("\t--transaction FILE\tchange many files, given by a file with one")
+            print("\t\t\t\tfilename and change per line, either all of")
+            print("\t\t\t\tthem or none of them")
+            print("\t--merge\t\t\tmerge kernel .config fragments into a .config,")
+            print("\t\t\t\tgiven after the filename")
+            print("\t--get\t\t\tprint the values for the keys given after")
+            print("\t\t\t\tthe filename as JSON, or after -- with -m")
+            print("\t--get-all\t\tprint the values for all keys as JSON")
+            print("\t-0 or --null\t\tprint --get values separated by NUL instead")
+            print("\t--cache[=DIR]\t\tkeep the results of -b and -m in a cache,")
+            print("\t\t\t\tfor files with the same contents")
+            print("\t--cache-size MB\t\tthe size limit of the cache, 64 by default")
+            print("\t--no-cache\t\tdo not use the cache, even if $SETCONF_CACHE is set")
+            print("\t--dialect NAME\t\tonly try the assignments and comments of a")
+            print("\t\t\t\tformat: kconfig, shell, make, ini, header,")
+            print("\t\t\t\tyaml or generic, or auto to detect it")
+            print("\t--watch\t\t\tmake the changes again each time the files")
+            print("\t\t\t\tare changed by something else, on Linux")
+            print("\t--include PATTERN\tonly change files that match the pattern,")
+            print("\t\t\t\twhen searching directories with -m")
+            print("\t--daemon [SOCKET]\tkeep files in memory and change them when")
+            print("\t\t\t\tasked to by setconf-client")
             print("")
             print("Examples:")
             print("\tsetconf Makefile.defaults NETSURF_USE_HARU_PDF NO")
@@ -825,8 +2874,20 @@ def main(args=argv[1:]):
             print("\tsetconf PKGBUILD sha256sums \"('123abc' 'abc123')\" ')'")
             print("\tsetconf app.py NUMS \"[1, 2, 3]\" ']'")
             print("\tsetconf -a server.conf ABC 123")
+            print("\tsetconf -a --after '[server]' server.ini port 8080")
             print("\tsetconf -d linux/printk.h CONSOLE_LOGLEVEL_DEFAULT=4")
+            print("\tsetconf -b -d config.h HAVE_X 1 HAVE_Y 0")
             print("\tsetconf -u kernel_config CONFIG_MAGIC_SYSRQ=y")
+            print("\tsetconf -b Makefile CC clang CFLAGS -O2")
+            print("\tsetconf -b kernel_config edits.txt")
+            print("\tsetconf -m --include '*.conf' /etc/foo.d -- timeout 30")
+            print("\tsetconf --merge .config fragment.config")
+            print("\tsetconf --sync --transaction deploy.txt")
+            print("\tsetconf --check -m /etc/foo.d -- timeout 30")
+            print("\tsetconf --watch -b /etc/foo.conf timeout 30 retries 3")
+            print("\tgit show HEAD:app.conf | setconf - timeout 30 > app.conf.new")
+            print("\tsetconf --get Makefile CC CFLAGS")
+            print("\tsetconf --dialect=auto settings.ini timeout 30")
             print("")
         elif args[0] in ["-v", "--version"]:
             print(VERSION)
@@ -834,47 +2895,237 @@ def main(args=argv[1:]):
 
     # more than one argument or flag given
 
-    flags = {"define": False, "add": False, "uncomment": False}
-    parsed_args = []
-    for arg in args:
-        if arg == "-d" or arg == "--define":
-            flags["define"] = True
-        elif arg == "-a" or arg == "--add":
-            flags["add"] = True
-        elif arg == "-u" or arg == "--uncomment":
-            flags["uncomment"] = True
+    options, flag_args, parsed_args = parse_args(args)
+    if options["stats"]:
+        # Run without --stats while collecting the stats, and write them to stderr.
+        # Only this process is measured, so -m runs all changes in this process.
+        args = [arg for arg in args if arg != "--stats" and not arg.startswith("--stats=")]
+        start_stats()
+        try:
+            main(["--jobs=1"] + args if options["multiple"] else args)
+        finally:
+            stats = stop_stats()
+            if options["stats"] == "json":
+                from json import dumps
+                stderr.write(dumps(stats.asdict(), sort_keys=True) + "\n")
+            else:
+                stderr.write(stats.report() + "\n")
+        return
+    if (options["check"] or options["diff"]) and CHECK is None:
+        # Run again without writing any files, then exit with 1 if files would be changed.
+        # -m changes the files in this process, so that the first change can end the run.
+        check = start_check(options["diff"])
+        try:
+            main(["--jobs=1"] + args if options["multiple"] else args)
+        except ChangesFound:
+            pass
+        except SystemExit as e:
+            # Usage errors exit with 1, which would look like changes were found
+            if e.code == 1:
+                sysexit(2)
+            raise
+        finally:
+            stop_check()
+        if check.changed:
+            sysexit(1)
+        return
+    if options["cache"] not in [None, False] and CACHE is None:
+        # Run again with the cache enabled, and disable it afterwards
+        enable_cache(options["cache"] or None, options["cache_size"])
+        try:
+            main(args)
+        finally:
+            disable_cache()
+        return
+    if options["dialect"] is not None and not options["multiple"]:
+        # Run again without --dialect, with the dialect in use, and go back to the previous one
+        # afterwards. With -m, the dialect is used for each file by changefiles or getfiles.
+        dialect = options["dialect"]
+        if dialect == "auto":
+            dialect = detect_dialect(parsed_args[0]) if parsed_args else None
+        rest, kept = list(args[:options["optionargs"]]), []
+        while rest:
+            arg = rest.pop(0)
+            if arg == "--dialect":
+                rest = rest[1:]
+            elif not arg.startswith("--dialect="):
+                kept.append(arg)
+        args = kept + args[options["optionargs"]:]
+        previous = use_dialect(dialect)
+        try:
+            main(args)
+        finally:
+            use_dialect(previous)
+        return
+    if options["watch"] and not options["multiple"]:
+        # Make the changes, then make them again each time the file is changed by something
+        # else. With -m, the files are watched by the code for -m instead.
+        if options["get"] or options["check"] or options["diff"] or "-" in [options["transaction"]] + parsed_args[:1]:
+            print("--watch can not be combined with --get, --check, --diff or stdin")
+            sysexit(1)
+        if options["transaction"] is not None:
+            filenames = [filename for filename, _ in read_edits(options["transaction"], parse_file_edits)]
+        elif parsed_args:
+            filenames = parsed_args[:1]
         else:
-            parsed_args.append(arg)
+            sysexit(1)
+        args = [arg for arg in args[:options["optionargs"]] if arg != "--watch"] + args[options["optionargs"]:]
+        watchfiles(filenames, lambda changed: main(args))
+        return
+    flags = {"define": options["define"], "add": options["add"], "uncomment": options["uncomment"]}
+    batch, stream, sync, nth = options["batch"], options["stream"], options["sync"], options["nth"]
+    if parsed_args[:1] == ["-"] and not options["multiple"]:
+        # Change stdin and write it to stdout, one line at a time
+        stream = True
 
     has_flags = True in flags.values()
 
+    if options["after"] is not None and (not flags["add"] or batch or stream or options["multiple"]):
+        print("--after can only be used with -a, for a single change")
+        sysexit(1)
+
+    if nth and (flags["add"] or flags["define"] or batch or options["multiple"] or len(parsed_args) == 4):
+        print("--nth can not be combined with -a, -d, -b, -m or a multiline value")
+        sysexit(1)
+
+    if options["transaction"] is not None:
+        # Changes to many files, where either all or none of the files are changed. Given by
+        # a file with one "filename [flags] key value" per line, or "-" for stdin.
+        if parsed_args or flag_args or batch or stream or nth or options["multiple"]:
+            print("--transaction can only be combined with --sync")
+            sysexit(1)
+        transaction = Transaction(sync)
+        try:
+            for filename, edit in read_edits(options["transaction"], parse_file_edits):
+                transaction.batch(filename, [edit])
+            transaction.commit()
+        except (IOError, OSError) as e:
+            print("No files were changed: %s" % (e))
+            sysexit(2)
+        return
+
+    if options["get"]:
+        # Read values: "filename key [key ...]", or "files, globs or directories -- key [key ...]"
+        # with -m. With --get-all, only the filename or the files are given.
+        if options["multiple"]:
+            if "--" in parsed_args:
+                paths, keys = parsed_args[:parsed_args.index("--")], parsed_args[parsed_args.index("--") + 1:]
+            else:
+                paths, keys = parsed_args, []
+        else:
+            paths, keys = parsed_args[:1], parsed_args[1:]
+        if options["get"] == "--get-all":
+            if keys:
+                sysexit(1)
+            keys = None
+        if not paths or keys == []:
+            sysexit(1)
+        if not options["multiple"]:
+            printvalues(get_values(readfile(paths[0]), keys), keys, null=options["null"])
+            return
+        failed = False
+        for filename, values, error in getfiles(paths, keys, options["include"], options["jobs"], options["dialect"]):
+            if error is not None:
+                stderr.write("%s: error: %s\n" % (filename, error))
+                failed = True
+            else:
+                printvalues(values, keys, filename, options["null"])
+        if failed:
+            sysexit(2)
+        return
+
+    if options["multiple"]:
+        # The same changes to many files: "files, globs or directories -- key value"
+        if "--" not in parsed_args:
+            sysexit(1)
+        paths = parsed_args[:parsed_args.index("--")]
+        edit_args = parsed_args[parsed_args.index("--") + 1:]
+        if batch:
+            edits = batch_edits(edit_args, flag_args)
+        else:
+            edits = [parse_edit(flag_args + edit_args)]
+        if not paths or not edits or None in edits:
+            sysexit(1)
+
+        def changeall(paths, include, processes):
+            """Change the files and print the status for each file, then exit with 2 if any failed"""
+            counts = {}
+            results = changefiles(paths, edits, include, processes, sync, options["dialect"])
+            for filename, status in results:
+                if CHECK is None or status.startswith("error"):
+                    print("%s: %s" % (filename, status))
+                status = status.split(":")[0]
+                counts[status] = counts.get(status, 0) + 1
+            if CHECK is None:
+                print("%d changed, %d unchanged, %d skipped, %d failed" %
+                      (counts.get("changed", 0), counts.get("unchanged", 0), counts.get("skipped", 0),
+                       counts.get("error", 0)))
+            if counts.get("error"):
+                sysexit(2)
+
+        if options["watch"]:
+            # Only the files that are found now are watched, and only the changed files are changed again.
+            # The files are changed by this process, so that watch knows which files were written.
+            if options["check"] or options["diff"]:
+                print("--watch can not be combined with --check or --diff")
+                sysexit(1)
+            watchfiles(list(findfiles(paths, options["include"])), lambda changed: changeall(changed, None, 1))
+            return
+        changeall(paths, options["include"], options["jobs"])
+        return
+
+    if options["merge"]:
+        # Kernel configuration fragments: "filename fragment [fragment ...]"
+        if len(parsed_args) < 2:
+            sysexit(1)
+        mergefile(parsed_args[0], parsed_args[1:], sync=sync)
+        return
+
+    if batch:
+        # Many changes to one file: "filename editsfile" or "filename key value [key value ...]"
+        edits = batch_edits(parsed_args[1:], flag_args)
+        if not edits or None in edits:
+            sysexit(1)
+        filename = parsed_args[0]
+        if "add" in [edit[0] for edit in edits]:
+            create_if_missing(filename)
+        if stream:
+            streamfile(filename, edits, sync=sync)
+        else:
+            changefile_batch(filename, edits, sync=sync)
+        return
+
+    if stream and len(parsed_args) in [2, 3]:
+        # Single line change, one line at a time
+        if nth:
+            print("--nth can not be combined with --stream or stdin")
+            sysexit(1)
+        filename = parsed_args[0]
+        edit = parse_edit(flag_args + parsed_args[1:])
+        if edit is None:
+            sysexit(2)
+        if flags["add"]:
+            create_if_missing(filename)
+        streamfile(filename, [edit], sync=sync)
+        return
+
     if not has_flags and len(parsed_args) == 2:
         # Single line replace: "x=123" or "x+=2"
         filename = parsed_args[0]
         keyvalue = bs(parsed_args[1])
         if b"+=" in keyvalue:
             key, value = keyvalue.split(b"+=", 1)
-            try:
-                with open(filename, 'rb') as f:
-                    data = f.read()
-            except IOError:
-                print("Can't read %s" % (filename))
-                sysexit(2)
-            datavalue = get_value(data, key)
-            changefile(filename, key, inc(datavalue, value))
+            data = readfile(filename)
+            datavalue = get_value(data, key, max(nth, 1))
+            changefile(filename, key, inc(datavalue, value), nth=nth, sync=sync)
         elif b"-=" in keyvalue:
             key, value = keyvalue.split(b"-=", 1)
-            try:
-                with open(filename, 'rb') as f:
-                    data = f.read()
-            except IOError:
-                print("Can't read %s" % (filename))
-                sysexit(2)
-            datavalue = get_value(data, key)
-            changefile(filename, key, dec(datavalue, value))
+            data = readfile(filename)
+            datavalue = get_value(data, key, max(nth, 1))
+            changefile(filename, key, dec(datavalue, value), nth=nth, sync=sync)
         elif b"=" in keyvalue:
             key, value = keyvalue.split(b"=", 1)
-            changefile(filename, key, value)
+            changefile(filename, key, value, nth=nth, sync=sync)
         else:
             sysexit(2)
     elif has_flags and len(parsed_args) == 2:
@@ -896,13 +3147,7 @@ def main(args=argv[1:]):
             key = firstpart(keyvalue, False)
 
             # Change the file if possible, if not, add the key value
-            if changefile(filename, key, value, dummyrun=True):
-                changefile(filename, key, value)
-            else:
-                with open(filename, 'rb') as f:
-                    data = f.read()
-                if not has_key(data, key):
-                    addtofile(filename, keyvalue)
+            addfile(filename, key, value, keyvalue, options["after"], sync)
         elif flags["define"]:
             filename = parsed_args[0]
             keyvalue = bs(parsed_args[1])
@@ -919,7 +3164,7 @@ def main(args=argv[1:]):
             key = firstpart(keyvalue, False)
 
             # Change the #define value in the file
-            changefile(filename, key, value, define=True)
+            changefile(filename, key, value, define=True, sync=sync)
         elif flags["uncomment"]:
             filename = parsed_args[0]
             keyvalue = bs(parsed_args[1])
@@ -933,19 +3178,19 @@ def main(args=argv[1:]):
                 # No assigment symbol, use the argument as the key
                 key = keyvalue
                 # Uncomment the given key
-                changefile(filename, key, "", uncomment_first=True)
+                changefile(filename, key, "", uncomment_first=True, nth=nth, sync=sync)
             else:
                 # Split keyvalue on the assignment symbol to get a key and a value
                 _, value = keyvalue.split(assignment, 1)
                 key = firstpart(keyvalue, False)
                 # Uncomment the key in the file, then try to set the value
-                changefile(filename, key, value, uncomment_first=True)
+                changefile(filename, key, value, uncomment_first=True, nth=nth, sync=sync)
     elif not has_flags and len(parsed_args) == 3:
         # Single line replace ("x 123")
         filename = parsed_args[0]
         key = bs(parsed_args[1])
         value = bs(parsed_args[2])
-        changefile(filename, key, value)
+        changefile(filename, key, value, nth=nth, sync=sync)
     elif has_flags and len(parsed_args) == 3:
         if flags["add"]:
             filename = parsed_args[0]
@@ -955,35 +3200,28 @@ def main(args=argv[1:]):
             create_if_missing(filename)
 
             # Change the file if possible, if not, add the key value
-            if changefile(filename, key, value, dummyrun=True):
-                changefile(filename, key, value)
-            else:
-                keyvalue = key + b"=" + value
-                with open(filename, 'rb') as f:
-                    data = f.read()
-                if not has_key(data, key):
-                    addtofile(filename, keyvalue)
+            addfile(filename, key, value, after=options["after"], sync=sync)
         elif flags["uncomment"]:
             filename = parsed_args[0]
             key = bs(parsed_args[1])
             value = bs(parsed_args[2])
 
             # Uncomment the key in the file, then try to set the value
-            changefile(filename, key, value, uncomment_first=True)
+            changefile(filename, key, value, uncomment_first=True, nth=nth, sync=sync)
     elif not has_flags and len(parsed_args) == 4:
         # Multiline replace
         filename = parsed_args[0]
         key = bs(parsed_args[1])
         value = bs(parsed_args[2])
         endstring = bs(parsed_args[3])
-        changefile_multiline(filename, key, value, endstring)
+        changefile_multiline(filename, key, value, endstring, sync=sync)
     elif has_flags and len(parsed_args) == 4:
         # Multiline replace
         filename = parsed_args[0]
         key = bs(parsed_args[1])
         value = bs(parsed_args[2])
         endstring = bs(parsed_args[3])
-        changefile_multiline(filename, key, value, endstring)
+        changefile_multiline(filename, key, value, endstring, sync=sync)
     else:
         sysexit(1)
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# setconf_client
+# Sends setconf commands to a running "setconf --daemon".
+# Takes the same arguments as setconf, and changes the files directly
+# if no daemon is running.
+#
+# GPL2
+#
+
+from json import dumps, loads
+from os import environ, getcwd, getuid, stat
+from os.path import join
+from socket import socket, AF_UNIX, SOCK_STREAM
+from struct import calcsize, unpack
+from sys import argv
+from sys import exit as sysexit
+
+
+def default_socket():
+    """Return the path of the Unix socket for the daemon, from $SETCONF_SOCKET
+    or in $XDG_RUNTIME_DIR or /tmp. The same as in setconf."""
+    if environ.get("SETCONF_SOCKET"):
+        return environ["SETCONF_SOCKET"]
+    return join(environ.get("XDG_RUNTIME_DIR") or "/tmp", "setconf-%d.sock" % (getuid()))
+
+
+def peeruid(s, socketpath):
+    """Return the user id of the process at the other end of a connected Unix socket,
+    or of the owner of the socket file where that can not be found."""
+    try:
+        from socket import SO_PEERCRED, SOL_SOCKET
+        return unpack("3i", s.getsockopt(SOL_SOCKET, SO_PEERCRED, calcsize("3i")))[1]
+    except ImportError:
+        return stat(socketpath).st_uid
+
+
+def connect(socketpath=None):
+    """Return a socket that is connected to the daemon, or None if no daemon is running.
+    A daemon that is run by another user is not used, since the socket may be in /tmp,
+    where anyone can listen first."""
+    socketpath = socketpath or default_socket()
+    s = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        s.connect(socketpath)
+        if peeruid(s, socketpath) == getuid():
+            return s
+    except (IOError, OSError):
+        pass
+    s.close()
+    return None
+
+
+def request(s, args, cwd=None):
+    """Send a setconf command to the daemon over a connected socket.
+    Returns the exit status and the output."""
+    s.sendall(dumps({"args": list(args), "cwd": cwd or getcwd()}).encode("utf-8") + b"\n")
+    response = b""
+    while not response.endswith(b"\n"):
+        chunk = s.recv(65536)
+        if not chunk:
+            raise IOError("No response from the daemon")
+        response += chunk
+    response = loads(response.decode("utf-8"))
+    return response["status"], response["output"]
+
+
+def main(args=argv[1:]):
+    s = None
+    if len(args) > 1:
+        s = connect()
+    if s is None:
+        # No daemon is running, or the arguments are for help, version or tests
+        import setconf
+        setconf.main(args)
+        return
+    try:
+        status, output = request(s, args)
+    except (IOError, OSError, ValueError) as e:
+        print("setconf daemon: %s" % (e))
+        sysexit(2)
+    finally:
+        s.close()
+    if status is None:
+        # The daemon can not run these arguments, so run setconf here instead
+        import setconf
+        setconf.main(args)
+        return
+    if output:
+        print(output)
+    if status:
+        sysexit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Self tests for setconf, run with: setconf --test
+#
+# Kept in a separate module, so that they are not imported for every change.
+#
+
+from os import chmod, environ, listdir, mkdir, remove, replace, stat, symlink, umask
+from os.path import basename, dirname, exists, islink, join
+from shutil import rmtree
+from stat import S_IMODE
+from tempfile import mkdtemp, mkstemp
+from base64 import b64decode
+from errno import ENOSPC
+from io import BytesIO, StringIO
+import sys
+from sys import platform
+from threading import Thread
+from time import sleep
+
+from setconf import (DIALECTS, GENERIC, NL, AsyncEditor, ChangesFound, ConfigFile, Transaction, abatch, aset, bs,
+                     change, change_batch, change_contents, change_data, change_defines, change_multiline, changefile,
+                     changefile_batch, changefile_multiline, changefiles, changeline, detect_dialect, disable_cache,
+                     enable_cache, findfiles, get_value, get_values, getfiles, has_key, iterlines, kconfig_settings,
+                     main, make_daemon, merge_kconfig, mergefile, nthline, parse_edit, printvalues, replacefile,
+                     splitassignment, start_check, start_stats, stop_check, stop_stats, streamfile, streamlines,
+                     streammultiline, uncomment, uncomment_change, use_dialect, watch, writefile)
+
+
+def test_splitassignment():
+    passes = True
+    passes = passes and splitassignment(b"a==b") == (b"a", b"==", b"b")
+    passes = passes and splitassignment(b"x := 1 : 2") == (b"x ", b":=", b" 1 : 2")
+    passes = passes and splitassignment(b"a+=1") == (b"a+", b"=", b"1")
+    passes = passes and splitassignment(b"this=1") == (b"th", b"is", b"=1")
+    passes = passes and splitassignment(b"CONFIG_X is not set") == (b"CONFIG_X ", b"is", b" not set")
+    passes = passes and splitassignment(b"url: http://x") == (b"url", b":", b" http://x")
+    passes = passes and splitassignment(b"  // x = 1") == (None, None, None)
+    passes = passes and splitassignment(b"   ") == (None, None, None)
+    passes = passes and splitassignment(b"nothing here") == (None, None, None)
+    print("Splitassignment passes: %s" % (passes))
+    return passes
+
+
+def test_changeline():
+    passes = True
+    passes = passes and changeline(" // ost = 2", "3") == b" // ost = 2"
+    passes = passes and changeline("rabbits = DUMB", "cool") == b"rabbits = cool"
+    passes = passes and changeline(
+        "for ever and ever : never",
+        "and ever") == b"for ever and ever : and ever"
+    passes = passes and changeline(
+        "     for  ever  and  Ever   :=    beaver",
+        "TURTLE") == b"     for  ever  and  Ever   := TURTLE"
+    passes = passes and changeline("CC=g++", "baffled") == b"CC=baffled"
+    passes = passes and changeline("CC =\t\tg++", "baffled") == b"CC =\tbaffled"
+    passes = passes and changeline("cabal ==1.2.3", "1.2.4") == b"cabal ==1.2.4"
+    passes = passes and changeline(
+        "TMPROOT=${TMPDIR:=/tmp}",
+        "/nice/pants") == b"TMPROOT=/nice/pants"
+    passes = passes and changeline("    # ost = 2", "3") == b"    # ost = 2"
+
+    # The above passes, except for the first one
+
+    passes = passes and changeline("  ost = 2", "3") == b"  ost = 3"
+    passes = passes and changeline("   /* ost = 2 */", "3") == b"   /* ost = 2 */"
+    passes = passes and changeline("æøå =>\t123", "256") == bs("æøå =>\t256")
+    passes = passes and changeline("name=value # comment: whatever", "newvalue") == bs("name=newvalue")
+    passes = passes and changeline("name=value // comment: whatever", "newvalue") == bs("name=newvalue")
+    print("Changeline passes: %s" % (passes))
+    return passes
+
+
+def test_uncomment():
+    testcontent = b"""y = 1
+// x = 42
+  #CONFIG_EVERYTHING=y
+z := 9
+"""
+    testcontent_changed = b"""y = 1
+// x = 42
+  CONFIG_EVERYTHING="ABSOLUTELY NOT"
+z := 9
+"""
+    passes = True
+    splitted = testcontent.split(NL)
+    splitted = uncomment(splitted, "CONFIG_EVERYTHING")
+    elements = change(splitted, "CONFIG_EVERYTHING", "\"ABSOLUTELY NOT\"")
+    a = bytes.join(b"", elements)
+    b = bytes.join(b"", testcontent_changed.split(NL))
+    passes = passes and a == b
+    print("Uncomment passes: %s" % (passes))
+    return passes
+
+
+def test_change():
+    testcontent = b"""LIGHTS =    ON
+bananas= not present
+tea := yes
+    randombob    :ok
+
+"""
+    testcontent_changed = b"""LIGHTS = off
+bananas= not present
+tea := yes
+    randombob    :ok
+
+"""
+    passes = True
+    splitted = testcontent.split(NL)
+    elements = change(splitted, "LIGHTS", "off")
+    a = bytes.join(b"", elements)
+    b = bytes.join(b"", testcontent_changed.split(NL))
+    passes = passes and a == b
+    print("Change passes: %s" % (passes))
+    return passes
+
+
+def test_change_define():
+    passes = True
+
+    testcontent = b"#define X 12"
+    testcontent_changed = b"#define X 42"
+    output = change([testcontent], "X", "42", define=True)[0]
+    passes = passes and output == testcontent_changed
+
+    testcontent = b"   #define   X    12"
+    testcontent_changed = b"   #define   X    42"
+    output = change([testcontent], "X", "42", define=True)[0]
+    passes = passes and output == testcontent_changed
+
+    # Only the value is replaced, even if the key contains it
+    testcontent = b"#define X12 12 /* 12 */"
+    testcontent_changed = b"#define X12 42 /* 12 */"
+    output = change([testcontent], "X12", "42", define=True)[0]
+    passes = passes and output == testcontent_changed
+
+    # %define, and values with spaces in quotes and parentheses
+    lines = [b"%define X 1", b'#define Y "a b" // c', b"# define Z (1 + 2)", b"#define W", b"X=1"]
+    changed = [b"%define X 2", b'#define Y "c" // c', b"# define Z 3", b"#define W", b"X=1"]
+    passes = passes and change_defines(lines, {"X": b"2", "Y": b'"c"', "Z": b"3", "W": b"4"}) == changed
+    passes = passes and change_batch(lines, [("define", "X", "2"), ("define", "Y", '"c"'), ("define", "Z", "3")]) == changed
+    passes = passes and change_batch(lines, [("define", "X", "2"), ("set", "X", "3")]) == [b"%define X 2"] + lines[1:4] + [b"X=3"]
+
+    print("Change define passes: %s" % (passes))
+    return passes
+
+
+def test_changefile():
+    # Test data
+    testcontent = b"keys := missing" + NL + bs("døg = found") + NL * 3 + bs("æøåÆØÅ") + NL
+    testcontent_changed = b"keys := found" + NL + \
+        bs("døg = missing") + NL * 3 + bs("æøåÆØÅ") + NL
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    # Change the file with changefile
+    changefile(filename, "keys", "found")
+    changefile(filename, "døg", "missing")
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read().split(NL)[:-1]
+    # Values that look like options are only options before the filename
+    filename2 = mkstemp()[1]
+    with open(filename2, 'wb') as f:
+        f.write(b"LDFLAGS=" + NL + b"MAKEFLAGS=" + NL)
+    main(["--sync", filename2, "LDFLAGS", "-s"])
+    main([filename2, "MAKEFLAGS", "-j"])
+    main(["-a", filename2, "-b", "-n"])
+    with open(filename2, 'rb') as f:
+        newcontent2 = f.read()
+    remove(filename2)
+    # Do the tests
+    passes = True
+    passes = passes and newcontent == testcontent_changed.split(NL)[:-1]
+    passes = passes and newcontent2 == b"LDFLAGS=-s" + NL + b"MAKEFLAGS=-j" + NL + b"-b=-n" + NL
+    print("Changefile passes: %s" % (passes))
+    return passes
+
+
+def test_writefile():
+    filename = mkstemp()[1]
+    linkname = filename + ".link"
+    symlink(filename, linkname)
+    writefile(filename, b"x=1" + NL)
+    chmod(filename, 0o640)
+    before = stat(filename)
+    passes = True
+    # Writing the same contents again should not touch the file
+    passes = passes and not writefile(linkname, b"x=1" + NL, b"x=1" + NL)
+    passes = passes and stat(filename).st_ino == before.st_ino
+    # Changed contents replace the file that the symlink points to, with the same mode
+    passes = passes and writefile(linkname, b"x=2" + NL, b"x=1" + NL, sync=True)
+    passes = passes and islink(linkname)
+    passes = passes and S_IMODE(stat(filename).st_mode) == 0o640
+    with open(filename, 'rb') as f:
+        passes = passes and f.read() == b"x=2" + NL
+    # A failed write leaves the file as it is, instead of writing it in place
+    def failing(f):
+        f.write(b"x")
+        raise OSError(ENOSPC, "No space left on device")
+    try:
+        replacefile(filename, failing)
+        passes = False
+    except OSError:
+        pass
+    with open(filename, 'rb') as f:
+        passes = passes and f.read() == b"x=2" + NL
+    passes = passes and not [name for name in listdir(dirname(filename)) if name.startswith("." + basename(filename))]
+    # New files get the default mode for the umask, without the umask being changed
+    mask = umask(0o022)
+    try:
+        writefile(filename + ".new", b"x=1" + NL)
+        passes = passes and S_IMODE(stat(filename + ".new").st_mode) == 0o644 and umask(mask) == 0o022
+    finally:
+        umask(mask)
+    remove(filename + ".new")
+    remove(linkname)
+    remove(filename)
+    print("Writefile passes: %s" % (passes))
+    return passes
+
+
+def test_uncomment_change():
+    lines = [b"# x=1", b"#x = 2", b"  // x: 3", b"-- x 4", b"#  x=5 # y", b"/* x=1 */", b"# xy=2", b"",
+             b"## x=1", b"# # x=1", b"# x is not set", b"y=x", b"x"]
+    passes = True
+    for key in [b"x", b"xy", b"x ", b"y", b"#"]:
+        for value in [b"1", b""]:
+            passes = passes and uncomment_change(lines, key, value) == change(uncomment(lines, key), key, value)
+            # Only the n'th occurrence is uncommented and changed, the other lines are kept
+            expected = change(uncomment(lines, key), key, value, nth=2)
+            newlines = uncomment_change(lines, key, value, nth=2)
+            changed = [number for number, line in enumerate(newlines) if line != lines[number]]
+            passes = passes and len(changed) <= 1 and all(newlines[number] == expected[number] for number in changed)
+    passes = passes and uncomment_change([b"#x=1", b"#x=2", b"#x=3"], "x", "5", nth=2) == [b"#x=1", b"x=5", b"#x=3"]
+    print("Uncomment and change passes: %s" % (passes))
+    return passes
+
+
+def test_change_data():
+    data = NL.join([b"# x=1", b"xy=2", b"  x = 3", b"y=x", b"", b"x: 4 # x", b"", b""])
+    lines = data.split(NL)[:-2]
+    passes = True
+    for key in [b"x", b"xy", b"y", b"z", b""]:
+        for uncomment_first in [False, True]:
+            if uncomment_first:
+                expected = NL.join(uncomment_change(lines, key, b"5")) + NL
+            else:
+                expected = NL.join(change(lines, key, b"5")) + NL
+            passes = passes and change_data(data, key, b"5", uncomment_first) == expected
+    # Contents without the key are returned as they are
+    passes = passes and change_data(b"a=1" + NL, b"x", b"5") == b"a=1" + NL
+    passes = passes and change_data(b"x=1", b"x", b"5") == b"x=5"
+    print("Change data passes: %s" % (passes))
+    return passes
+
+
+def test_changefile_uncomment():
+    # Test data
+    testcontent = b"""#   y = 1
+// x = 42
+  #DESTROY_EVERYTHING=y
+# z  :=  123
+"""
+    testcontent_changed = b"""  y = 2
+x = 9000
+  #DESTROY_EVERYTHING=y
+z  := 7
+"""
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    # Change the file with changefile
+    changefile(filename, "x", "9000", uncomment_first=True)
+    changefile(filename, "DESTROY_EVERYTHING", "!IGNORED!", uncomment_first=False)
+    changefile(filename, "z", "7", uncomment_first=True)
+    changefile(filename, "y", "2", uncomment_first=True)
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read().split(NL)[:-1]
+    # Do the tests
+    passes = True
+    passes = passes and newcontent == testcontent_changed.split(NL)[:-1]
+    print("Changefile and uncomment passes: %s" % (passes))
+    return passes
+
+
+def test_changefile_uncomment_kernel():
+    # Test data
+    testcontent = b"""# CONFIG_KERNEL_XZ is not set
+"""
+    testcontent_changed = b"""CONFIG_KERNEL_XZ=y
+"""
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    # Change the file with changefile
+    changefile(filename, "CONFIG_KERNEL_XZ", "y", uncomment_first=True)
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read().split(NL)[:-1]
+    # Do the tests
+    passes = True
+    passes = passes and newcontent == testcontent_changed.split(NL)[:-1]
+    print("Changefile kernel config passes: %s" % (passes))
+    return passes
+
+
+def test_nth():
+    testcontent = b"x = 1" + NL + b"# x = 2" + NL + b"y := 3" + NL + b"x=4" + NL
+    passes = True
+    lines = testcontent.split(NL)
+    passes = passes and nthline(lines, "x", 2) == (3, b"x=4") and nthline(lines, "y", 1) == (2, b"y := 3")
+    passes = passes and nthline(lines, "x", 2, uncomment_first=True) == (1, b"x = 2")
+    passes = passes and nthline(lines, "x", 4, uncomment_first=True) == (None, None)
+    passes = passes and uncomment_change(lines, "x", "5", nth=2)[1] == b"x = 5"
+    passes = passes and has_key(testcontent, b"y") and not has_key(testcontent, b"z")
+    passes = passes and get_value(testcontent, b"x") == b"1"
+    passes = passes and get_value(testcontent, b"x", 2) == b"4"
+    passes = passes and get_value(testcontent, b"x", 3) == b"" and get_value(testcontent, b"y") == b"3"
+    passes = passes and not has_key(testcontent, b"") and not has_key(b"xy=1", b"x")
+    passes = passes and change(testcontent.split(NL), "x", "5", nth=2)[3] == b"x=5"
+    passes = passes and change(testcontent.split(NL), "x", "5", nth=2)[0] == b"x = 1"
+    print("Nth passes: %s" % (passes))
+    return passes
+
+
+def test_changefile_batch():
+    # Test data
+    testcontent = b"# CONFIG_A is not set" + NL + b"CONFIG_B=m" + NL + b"x = 1" + NL + \
+        b"#define MAX 10" + NL + b"// y = 2" + NL
+    testcontent_changed = b"CONFIG_A=y" + NL + b"CONFIG_B=n" + NL + b"x = 5" + NL + \
+        b"#define MAX 20" + NL + b"y = 3" + NL + b"z=7" + NL + b"w := 8" + NL
+    edits = [
+        ("uncomment", "CONFIG_A", "y"),
+        ("set", "CONFIG_B", "n"),
+        ("+=", "x", "3"),
+        ("define", "MAX", "20"),
+        ("add", "z", "7"),
+        ("uncomment", "y", "3"),
+        ("+=", "x", "1"),
+        ("add", "w", "8", "w := 8"),
+        ("add", "x", "5"),
+    ]
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    # Change the file with changefile_batch
+    changefile_batch(filename, edits)
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    remove(filename)
+    # Do the tests
+    passes = True
+    passes = passes and newcontent == testcontent_changed
+    passes = passes and parse_edit(["-u", "CONFIG_X=y"]) == ("uncomment", b"CONFIG_X", b"y")
+    passes = passes and parse_edit(["pkgrel+=1"]) == ("+=", b"pkgrel", b"1")
+    passes = passes and parse_edit(["-a", "Z:=5"]) == ("add", b"Z", b"5", b"Z:=5")
+    passes = passes and parse_edit(["x"]) is None
+    print("Changefile batch passes: %s" % (passes))
+    return passes
+
+
+def test_streamfile():
+    # Test data
+    testcontent = b"# x = 1" + NL + b"y = 2" + NL + NL + NL
+    testcontent_changed = b"x = 3" + NL + b"y = 4" + NL + b"z=5" + NL
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    # Change the file with streamfile
+    streamfile(filename, [("uncomment", "x", "3"), ("+=", "y", "2"), ("add", "z", "5")])
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    remove(filename)
+    # Do the tests
+    passes = True
+    passes = passes and newcontent == testcontent_changed
+    passes = passes and list(iterlines(BytesIO(b"ab" + NL + NL + b"c"), 1)) == [b"ab", b"", b"c"]
+    print("Streamfile passes: %s" % (passes))
+    return passes
+
+
+def test_filter():
+    passes = True
+    # Line based changes give the same result as for a file
+    output = BytesIO()
+    streamlines(BytesIO(b"# x = 1" + NL + b"y = 2" + NL), output, [("uncomment", "x", "3"), ("add", "z", "5")])
+    passes = passes and output.getvalue() == b"x = 3" + NL + b"y = 2" + NL + b"z=5" + NL
+    # Multiline values give the same result as change_multiline, also when read a few bytes at a time
+    for data in [b"a=(1" + NL + b"2)" + NL + b"b=2" + NL, b"b=2" + NL + b"a=(1)", b"b=2", b"", b"a=(1" + NL]:
+        for size in [1, 3, 4096]:
+            output = BytesIO()
+            infile = BytesIO(data)
+            infile.read1 = lambda n=-1, infile=infile, size=size: infile.read(size)
+            try:
+                streammultiline(infile, output, "a", "(9)", ")")
+                passes = passes and output.getvalue() == change_multiline(data, "a", "(9)", ")")
+            except SystemExit:
+                try:
+                    change_multiline(data, "a", "(9)", ")")
+                    passes = False
+                except SystemExit:
+                    pass
+    print("Filter passes: %s" % (passes))
+    return passes
+
+
+def test_changefiles():
+    directory = mkdtemp()
+    try:
+        mkdir(join(directory, "sub"))
+        for name, contents in [("a.conf", b"x=1" + NL), ("b.conf", b"y=2" + NL),
+                               ("sub/c.conf", b"x = 3" + NL), ("sub/d.txt", b"x=4" + NL)]:
+            with open(join(directory, name), 'wb') as f:
+                f.write(contents)
+        passes = True
+        for processes in [1, 2]:
+            results = list(changefiles([directory], [("set", "x", "5")], ["*.conf"], processes))
+            passes = passes and results == [
+                (join(directory, "a.conf"), "changed" if processes == 1 else "unchanged"),
+                (join(directory, "b.conf"), "skipped"),
+                (join(directory, "sub", "c.conf"), "changed" if processes == 1 else "unchanged"),
+            ]
+        passes = passes and list(findfiles([join(directory, "*.conf")])) == [join(directory, "a.conf"),
+                                                                             join(directory, "b.conf")]
+        with open(join(directory, "sub", "c.conf"), 'rb') as f:
+            passes = passes and f.read() == b"x = 5" + NL
+    finally:
+        rmtree(directory)
+    print("Changefiles passes: %s" % (passes))
+    return passes
+
+
+def test_daemon():
+    from threading import Thread
+    from setconf_client import connect, request
+    from setconf_client import main as client_main
+    directory = mkdtemp()
+    try:
+        socketpath = join(directory, "setconf.sock")
+        server = make_daemon(socketpath, cachesize=1)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        filename = join(directory, "test.conf")
+        writefile(filename, b"x=1" + NL + b"# y = 2" + NL)
+        passes = True
+        s = connect(socketpath)
+        passes = passes and request(s, [filename, "x+=2"]) == (0, "")
+        passes = passes and request(s, ["-u", filename, "y", "3"]) == (0, "")
+        # Change the file behind the back of the daemon
+        with open(filename, 'ab') as f:
+            f.write(b"z=4" + NL)
+        passes = passes and request(s, ["test.conf", "z", "5"], directory) == (0, "")
+        passes = passes and request(s, ["-n", "2", "test.conf", "z", "5"], directory) == \
+            (None, "Not supported by the daemon")
+        passes = passes and request(s, ["missing.conf", "z", "5"], directory)[0] == 2
+        # Bad requests are answered, and the connection can still be used
+        for bad in [b"{", b"[]", b'{"args": [1], "cwd": "/"}']:
+            s.sendall(bad + b"\n")
+            passes = passes and s.recv(65536).startswith(b'{"status": 2, "output": "Invalid request')
+        # Changes through a symlink and through the file itself use the same cached contents
+        symlink(filename, join(directory, "link.conf"))
+        passes = passes and request(s, ["link.conf", "z", "6"], directory) == (0, "")
+        passes = passes and request(s, ["./test.conf", "z", "5"], directory) == (0, "")
+        s.close()
+        # Neither a running daemon nor a file that is not a socket is replaced by a new daemon
+        for path in [socketpath, filename]:
+            try:
+                make_daemon(path)
+                passes = False
+            except OSError:
+                pass
+        s = connect(socketpath)
+        passes = passes and s is not None and connect(filename) is None
+        s.close()
+        # Arguments that the daemon can not run are run by the client instead
+        socketpath, environ["SETCONF_SOCKET"] = environ.get("SETCONF_SOCKET"), socketpath
+        try:
+            client_main(["-n", "1", filename, "x", "4"])
+            try:
+                client_main(["--check", filename, "x", "4"])
+            except SystemExit:
+                passes = False
+        finally:
+            if socketpath is None:
+                del environ["SETCONF_SOCKET"]
+            else:
+                environ["SETCONF_SOCKET"] = socketpath
+        server.shutdown()
+        server.server_close()
+        with open(filename, 'rb') as f:
+            passes = passes and f.read() == b"x=4" + NL + b"y = 3" + NL + b"z=5" + NL
+    finally:
+        rmtree(directory)
+    print("Daemon passes: %s" % (passes))
+    return passes
+
+
+def test_configfile():
+    # Test data
+    testcontent = b"# x = 1" + NL + b"xy := 2" + NL + b"  y =  3  " + NL + b"y=4" + NL
+    testcontent_changed = b"x = 7" + NL + b"xy := 2" + NL + b"  y = 5" + NL + b"y=5" + NL + b"z=6" + NL
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    conf = ConfigFile(filename)
+    passes = True
+    passes = passes and conf.get("x") is None and "xy" in conf and "x" not in conf
+    passes = passes and conf.get("y") == b"3" and conf.get("y", nth=2) == b"4"
+    passes = passes and not conf.save()
+    conf.uncomment("x", "7")
+    conf.set("y", "5")
+    conf.add("z", "6")
+    passes = passes and conf.get("x") == b"7" and conf.get("y") == b"5"
+    line = conf.lines("x")[0]
+    passes = passes and (line.start, line.keystart, line.keyend, line.valuestart, line.assignment) == (0, 0, 1, 3, b"=")
+    line = ConfigFile(filename, b"  // ab = c").lines("ab")
+    passes = passes and ConfigFile(filename, b"x=1").get(" ") is None and "" not in ConfigFile(filename, b"x=1")
+    passes = passes and line == []
+    passes = passes and conf.save()
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    passes = passes and newcontent == testcontent_changed
+    remove(filename)
+    try:
+        ConfigFile(filename + ".missing")
+        passes = False
+    except IOError:
+        pass
+    print("ConfigFile passes: %s" % (passes))
+    return passes
+
+
+def test_stats():
+    # Test data
+    testcontent = b"# x=1" + NL + NL + b"y=2" + NL + b"z=3" + NL
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    passes = stop_stats() is None
+    stats = start_stats(trace_memory=False)
+    changefile(filename, "x", "5", uncomment_first=True)
+    passes = passes and stop_stats() is stats and stats.peak_memory is None
+    passes = passes and stats.bytes_read == len(testcontent) and stats.bytes_written == len(testcontent) - 2
+    passes = passes and sorted(stats.phases) == ["change", "read", "write"]
+    # Only the lines that contain the key are parsed when uncommenting and changing
+    passes = passes and (stats.lines_scanned, stats.lines_parsed, stats.lines_skipped) == (4, 1, 3)
+    passes = passes and stats.matches == 1
+    # Blank lines are skipped without being parsed
+    stats = start_stats()
+    main(["-b", filename, "z", "4"])
+    stop_stats()
+    passes = passes and (stats.lines_scanned, stats.lines_parsed, stats.lines_skipped, stats.matches) == (4, 3, 1, 1)
+    passes = passes and stats.peak_memory > 0 and stats.seconds >= sum(stats.phases.values())
+    with open(filename, 'rb') as f:
+        passes = passes and f.read() == b"x=5" + NL + NL + b"y=2" + NL + b"z=4" + NL
+    # Files changed by changefiles are counted too
+    stats = start_stats(trace_memory=False)
+    passes = passes and list(changefiles([filename], [("set", "z", "6")], processes=1)) == [(filename, "changed")]
+    stop_stats()
+    passes = passes and stats.bytes_read == stats.bytes_written == len(testcontent) - 2
+    passes = passes and sorted(stats.phases) == ["change", "read", "write"]
+    remove(filename)
+    print("Stats passes: %s" % (passes))
+    return passes
+
+
+def test_merge():
+    # Test data
+    testcontent = b"CONFIG_A=y" + NL + b"# CONFIG_B is not set" + NL + b"CONFIG_C=m" + NL + b"CONFIG_A=m" + NL
+    fragment = b"# Fragment" + NL + b"# CONFIG_A is not set" + NL + b"CONFIG_B=y " + NL + b"CONFIG_D=1" + NL
+    testcontent_changed = b"# CONFIG_A is not set" + NL + b"CONFIG_B=y" + NL + b"CONFIG_C=m" + NL + b"CONFIG_D=\"x\"" + NL
+    settings = kconfig_settings(fragment)
+    passes = list(settings) == [b"CONFIG_A", b"CONFIG_B", b"CONFIG_D"] and settings[b"CONFIG_B"] == b"CONFIG_B=y"
+    passes = passes and merge_kconfig(b"", {}) == b""
+    passes = passes and merge_kconfig(b"CONFIG_A=y", {}) == b"CONFIG_A=y"
+    passes = passes and merge_kconfig(b"", settings) == b"# CONFIG_A is not set" + NL + b"CONFIG_B=y" + NL + b"CONFIG_D=1" + NL
+    filename = mkstemp()[1]
+    fragments = [mkstemp()[1], mkstemp()[1]]
+    # Write the testfiles
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    with open(fragments[0], 'wb') as f:
+        f.write(fragment)
+    with open(fragments[1], 'wb') as f:
+        f.write(b"CONFIG_D=\"x\"")
+    # Later fragments override earlier ones
+    mergefile(filename, fragments)
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    passes = passes and newcontent == testcontent_changed
+    passes = passes and not mergefile(filename, fragments, dummyrun=True)
+    remove(filename)
+    for fragment in fragments:
+        remove(fragment)
+    print("Merge passes: %s" % (passes))
+    return passes
+
+
+def test_get_values():
+    # Test data
+    testcontent = b"# x=0" + NL + b" x = 1 " + NL + b"y:=2" + NL + b"x=3" + NL + b"z" + NL + b"w=" + NL
+    passes = get_values(testcontent, ["x", "y", "v"]) == {b"x": b"1", b"y": b"2"}
+    passes = passes and get_values(testcontent) == {b"x": b"1", b"y": b"2", b"w": b""}
+    passes = passes and get_values(testcontent, ["v"]) == {}
+    # The values are the same as for get_value
+    for key, value in get_values(testcontent).items():
+        passes = passes and get_value(testcontent, key) == value
+    # A key that is asked for more than once is only printed once
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        printvalues(get_values(testcontent, ["x", "x", "v"]), ["x", " x", "v"], "a.conf")
+    finally:
+        stdout, sys.stdout = sys.stdout, stdout
+    passes = passes and stdout.getvalue() == '{"filename": "a.conf", "values": {"x": "1", "v": null}}\n'
+    directory = mkdtemp()
+    try:
+        with open(join(directory, "a.conf"), 'wb') as f:
+            f.write(testcontent)
+        results = list(getfiles([directory, join(directory, "missing")], ["y"], processes=1))
+        passes = passes and results[0] == (join(directory, "a.conf"), {b"y": b"2"}, None)
+        passes = passes and results[1][:2] == (join(directory, "missing"), None) and results[1][2] is not None
+    finally:
+        rmtree(directory)
+    print("Get values passes: %s" % (passes))
+    return passes
+
+
+def test_async():
+    import asyncio
+    directory = mkdtemp()
+    try:
+        filenames = [join(directory, "%d.conf" % (i)) for i in range(3)]
+        for filename in filenames:
+            with open(filename, 'wb') as f:
+                f.write(b"x=0" + NL)
+
+        async def edits():
+            # Many edits to the same files at the same time. The tasks are created here, since
+            # gather does not start them in the given order on Python 3.6.
+            results = await asyncio.gather(*[asyncio.ensure_future(edit) for edit in
+                                             [abatch(filename, [("add", "k%d" % (i), str(i))])
+                                              for i in range(20) for filename in filenames] +
+                                             [aset(filename, "x", "1") for filename in filenames]])
+            try:
+                await aset(join(directory, "missing.conf"), "x", "1")
+                return False
+            except (IOError, OSError):
+                pass
+            # Adding keys creates missing files
+            await AsyncEditor(limit=1).batch(join(directory, "new.conf"), [("add", "x", "2")])
+            return results
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(edits())
+        finally:
+            loop.close()
+        passes = results == [True] * 63
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                passes = passes and f.read() == NL.join([b"x=1"] + [b"k%d=%d" % (i, i) for i in range(20)]) + NL
+        with open(join(directory, "new.conf"), 'rb') as f:
+            passes = passes and f.read() == b"x=2" + NL
+    finally:
+        rmtree(directory)
+    print("Async passes: %s" % (passes))
+    return passes
+
+
+def test_cache():
+    # Test data
+    testcontent = b"x=1" + NL + b"y=2" + NL
+    edits = [("set", "x", "3")]
+    directory = mkdtemp()
+    cache = enable_cache(join(directory, "cache"), maxsize=40)
+    try:
+        passes = change_contents(testcontent, edits) == b"x=3" + NL + b"y=2" + NL
+        passes = passes and listdir(cache.directory) == [basename(cache.path(testcontent, edits))]
+        # Results are found again without parsing the lines
+        stats = start_stats(trace_memory=False)
+        passes = passes and change_contents(testcontent, edits) == b"x=3" + NL + b"y=2" + NL
+        stop_stats()
+        passes = passes and stats.lines_scanned == 0
+        # Unchanged contents are stored as a marker
+        passes = passes and change_contents(testcontent, [("set", "y", "2")]) == testcontent
+        with open(cache.path(testcontent, [("set", "y", "2")]), 'rb') as f:
+            passes = passes and f.read() == b"="
+        # The size is kept track of without scanning the directory while it fits
+        passes = passes and cache.size == len(b"+x=3" + NL + b"y=2" + NL) + 1
+        # The least recently used result is removed when the cache is too large
+        passes = passes and change_contents(testcontent * 4, edits) == (b"x=3" + NL + b"y=2" + NL) * 4
+        passes = passes and len(listdir(cache.directory)) == 2 and cache.size <= 40
+    finally:
+        disable_cache()
+    passes = passes and change_contents(testcontent, edits) == b"x=3" + NL + b"y=2" + NL
+    # The cache is used by batch mode
+    filename = join(directory, "test.conf")
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    main(["--cache=" + cache.directory, "-b", filename, "y", "5"])
+    with open(filename, 'rb') as f:
+        passes = passes and f.read() == b"x=1" + NL + b"y=5" + NL
+    passes = passes and exists(cache.path(testcontent, [("set", "y", "5")]))
+    rmtree(directory)
+    print("Cache passes: %s" % (passes))
+    return passes
+
+
+def test_change_multiline():
+    passes = True
+    # test 1
+    testcontent = b"keys := missing" + NL + b"dog = found" + NL * 3
+    testcontent_changed = b"keys := found" + NL + b"dog = found" + NL * 3
+    a = change_multiline(testcontent, "keys", "found")
+    b = testcontent_changed
+    extracheck = testcontent.replace(b"missing", b"found") == testcontent_changed
+    passes = passes and a == b and extracheck
+    if not passes:
+        print("FAIL1")
+    # test 2
+    testcontent = bs('blabla\nOST=(a\nb)\n\nblabla\nÆØÅ')
+    testcontent_changed = bs('blabla\nOST=(c d)\n\nblabla\nÆØÅ')
+    a = change_multiline(testcontent, "OST", "(c d)", ")")
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL2")
+    # test 3
+    testcontent = bs('bläblä=1')
+    testcontent_changed = bs('bläblä=2')
+    a = change_multiline(testcontent, "bläblä", "2")
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL3")
+    # test 4
+    testcontent = b"\n"
+    testcontent_changed = b"\n"
+    a = change_multiline(testcontent, "blablañ", "ost")
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL4")
+    # test 5
+    testcontent = b""
+    testcontent_changed = b""
+    a = change_multiline(testcontent, "blabla", "ost")
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL5")
+    # test 6
+    testcontent = b"a=(1, 2, 3"
+    testcontent_changed = b"a=(1, 2, 3"
+    a = change_multiline(testcontent, "a", "(4, 5, 6)", ")", verbose=False)
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL6")
+    # test 7
+    testcontent = b"a=(1, 2, 3\nb=(7, 8, 9)"
+    testcontent_changed = b"a=(4, 5, 6)"
+    a = change_multiline(testcontent, "a", "(4, 5, 6)", ")")
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL7")
+    # test 8
+    testcontent = b"a=(0, 0, 0)\nb=(1\n2\n3\n)\nc=(7, 8, 9)"
+    testcontent_changed = b"a=(0, 0, 0)\nb=(4, 5, 6)\nc=(7, 8, 9)"
+    a = change_multiline(testcontent, "b", "(4, 5, 6)", ")")
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL8")
+    # test 9
+    testcontent = b"a=(0, 0, 0)\nb=(1\n2\n3\n)\nc=(7, 8, 9)\n\n"
+    testcontent_changed = b"a=(0, 0, 0)\nb=(1\n2\n3\n)\nc=(7, 8, 9)\n\n"
+    a = change_multiline(testcontent, "b", "(4, 5, 6)", "]", verbose=False)
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL9")
+    # test 10
+    testcontent = bs("""
+source=("http://prdownloads.sourceforge.net/maniadrive/ManiaDrive-$pkgver-linux-i386.tar.gz"
+        "maniadrive.desktop"
+        "ñlicense.txt"
+        "https://admin.fedoraproject.org/pkgdb/appicon/show/Maniadrive")
+md5sums=('5592eaf4b8c4012edcd4f0fc6e54c09c'
+         '064639f1b48ec61e46c524ae31eec520'
+         'afa5fac56d01430e904dd6716d84f4bf'
+         '9b5fc9d981d460a7b0c9d78e75c5aeca')
+
+build() {
+  cd "$srcdir/ManiaDrive-$pkgver-linux-i386"
+""")
+    testcontent_changed = bs("""
+source=("http://prdownloads.sourceforge.net/maniadrive/ManiaDrive-$pkgver-linux-i386.tar.gz"
+        "maniadrive.desktop"
+        "ñlicense.txt"
+        "https://admin.fedoraproject.org/pkgdb/appicon/show/Maniadrive")
+md5sums=('123abc' 'abc123')
+
+build() {
+  cd "$srcdir/ManiaDrive-$pkgver-linux-i386"
+""")
+    a = change_multiline(testcontent, "md5sums", "('123abc' 'abc123')", ")", verbose=False)
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL10")
+    # test 11
+    testcontent = b"x=(0, 0, 0)\nCHEESE\nz=2\n"
+    testcontent_changed = b"x=(4, 5, 6)\nz=2\n"
+    a = change_multiline(testcontent, "x", "(4, 5, 6)", "CHEESE", verbose=False)
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL11")
+    # test 12
+    testcontent = b"# md5sum=('abc123')\nmd5sum=('def456')\nmd5sum=('ghi789')\n"
+    testcontent_changed = b"# md5sum=('abc123')\nmd5sum=('OST')\nmd5sum=('ghi789')\n"
+    a = change_multiline(testcontent, "md5sum", "('OST')", "\n", verbose=False)
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL12")
+    # test 13
+    testcontent = b"# a=(1)\n" * 5000 + b"a=(2)\n"
+    testcontent_changed = b"# a=(1)\n" * 5000 + b"a=(3)\n"
+    a = change_multiline(testcontent, "a", "(3)", ")", verbose=False)
+    b = testcontent_changed
+    passes = passes and a == b
+    if not passes:
+        print("FAIL13")
+    # test 14
+    testcontent = b"# a=(1)\n"
+    a = change_multiline(testcontent, "a", "(3)", ")", verbose=False)
+    passes = passes and a == testcontent
+    if not passes:
+        print("FAIL14")
+    # result
+    print("Change multiline passes: %s" % (passes))
+    return passes
+
+
+def test_changefile_multiline():
+    # Test data
+    testcontent = b"keys := missing" + NL + b"dog = found" + NL * 3 + bs("æøåÆØÅ")
+    testcontent_changed = b"keys := found" + NL + b"dog = missing" + NL * 3 + bs("æøåÆØÅ")
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    # Change the file with changefile
+    changefile_multiline(filename, "keys", "found")
+    changefile_multiline(filename, "dog", "missing")
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+    # Do the tests
+    passes = True
+    passes = passes and newcontent == testcontent_changed
+    print("Changefile multiline passes: %s" % (passes))
+    return passes
+
+
+# Note that this test function may cause sysexit to be called if it fails
+# because it calls the main function directly
+
+
+def test_addline():
+    # --- TEST 1 ---
+    testcontent = b"# cache-ttl=65000" + NL + b"MOO=yes" + NL
+    testcontent_changed = b"# cache-ttl=65000" + NL + b"MOO=no" + NL + \
+        b"X=123" + NL + b"Y=345" + NL + b"Z:=567" + NL + \
+        b"FJORD => 999" + NL + b'vm.swappiness=1' + \
+        NL + b"cache-ttl=6" + NL
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)
+    # Change the file by adding keys and values
+    main(["-a", filename, "X", "123"])
+    main(["--add", filename, "Y=345"])
+    main(["-a", filename, "Z:=567"])
+    main(["--add", filename, "FJORD => 999"])
+    main(["--add", filename, "MOO", "no"])
+    main(["-a", filename, "vm.swappiness=1"])
+    main(["-a", filename, "vm.swappiness=1"])
+    main(["-a", filename, "cache-ttl=6"])
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read()
+
+    # --- TEST 2 ---
+    testcontent_changed2 = b"x=2" + NL
+    filename = mkstemp()[1]
+    # Write an empty testfile
+    open(filename, 'wb+').close()
+    # Change the file by adding keys and values
+    main(["-a", filename, "x=2"])
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent2 = f.read()
+
+    # --- TEST 3 ---
+    # Missing keys are appended without rewriting the file, after a missing final newline
+    testcontent_changed3 = b"a=1" + NL + b"b=2" + NL + b"c=3" + NL
+    filename = mkstemp()[1]
+    with open(filename, 'wb') as f:
+        f.write(b"a=1" + NL + b"b=2")
+    before = stat(filename)
+    main(["-a", filename, "c", "3"])
+    with open(filename, 'rb') as f:
+        newcontent3 = f.read()
+    inode3 = stat(filename).st_ino
+    remove(filename)
+
+    # --- TEST 4 ---
+    testcontent_changed4 = b"[a]" + NL + b"x=1" + NL + b"[b]" + NL + b"y=2" + NL + b"x=3" + NL + b"z=4" + NL
+    filename = mkstemp()[1]
+    with open(filename, 'wb') as f:
+        f.write(b"[a]" + NL + b"x=1" + NL + b"[b]" + NL + b"x=3" + NL)
+    main(["-a", "--after", "[b]", filename, "y=2"])
+    main(["-a", "--after", "[c]", filename, "z", "4"])
+    main(["-a", "--after", "[a]", filename, "y", "2"])
+    with open(filename, 'rb') as f:
+        newcontent4 = f.read()
+    remove(filename)
+
+    # --- TEST 5 ---
+    # Trailing blank lines are removed before a missing key is added, the same way as for -b
+    filename = mkstemp()[1]
+    with open(filename, 'wb') as f:
+        f.write(b"a=1" + NL * 3)
+    main(["-a", filename, "k", "v"])
+    with open(filename, 'rb') as f:
+        newcontent5 = f.read()
+    remove(filename)
+
+    # Do the tests
+    passes = True
+    passes = passes and (newcontent == testcontent_changed)
+    passes = passes and (newcontent2 == testcontent_changed2)
+    passes = passes and (newcontent3 == testcontent_changed3) and inode3 == before.st_ino
+    passes = passes and (newcontent4 == testcontent_changed4)
+    passes = passes and newcontent5 == change_contents(b"a=1" + NL * 3, [("add", "k", "v")]) == b"a=1" + NL + b"k=v" + NL
+
+    print("Addline passes: %s" % (passes))
+    return passes
+
+
+def test_latin1():
+    # Test data
+    testcontent = b64decode(
+        b"SGVsbG8sIHRoaXMgaXMgYW4gSVNPLTg4NTktMSBlbmNvZGVkIHRleHQgZmlsZS4gQmzlYuZyIG9n\nIHL4ZHZpbi4KCkFsc28sCng9Nwo=")
+    testcontent_changed = b64decode(
+        b"SGVsbG8sIHRoaXMgaXMgYW4gSVNPLTg4NTktMSBlbmNvZGVkIHRleHQgZmlsZS4gQmzlYuZyIG9n\nIHL4ZHZpbi4KCkFsc28sCng9NDIK")
+
+    filename = mkstemp()[1]
+    # Write the testfile
+    with open(filename, 'wb') as f:
+        f.write(testcontent)  # already bytes, no need to encode
+    # Change the file with changefile
+    changefile(filename, "x", "42")
+    # Read the file
+    with open(filename, 'rb') as f:
+        newcontent = f.read().split(NL)[:-1]
+    # Do the tests
+    passes = True
+    passes = passes and newcontent == testcontent_changed.split(NL)[:-1]
+    print("ISO-8859-1 passes: %s" % (passes))
+    return passes
+
+
+def test_dialects():
+    passes = True
+    # Detect the dialect from the filename, or else from the first bytes
+    passes = passes and detect_dialect("/x/Makefile", b"") is DIALECTS["make"]
+    passes = passes and detect_dialect("PKGBUILD", b"[a]\n") is DIALECTS["shell"]
+    passes = passes and detect_dialect("x", b"#!/bin/sh\nA=1\n") is DIALECTS["shell"]
+    passes = passes and detect_dialect("x", b"#\n# CONFIG_A is not set\nCONFIG_B=y\n") is DIALECTS["kconfig"]
+    passes = passes and detect_dialect("x", b"/* a */\n#ifndef A_H\n") is DIALECTS["header"]
+    passes = passes and detect_dialect("x", b"---\na: 1\n") is DIALECTS["yaml"]
+    passes = passes and detect_dialect("x", b"; comment\n[server]\nport=1\n") is DIALECTS["ini"]
+    passes = passes and detect_dialect("x", b"a=1\n") is GENERIC
+    previous = use_dialect("kconfig")
+    try:
+        passes = passes and previous is GENERIC
+        # "is" is only an assignment as a word
+        passes = passes and splitassignment(b"this=1") == (b"this", b"=", b"1")
+        passes = passes and splitassignment(b"CONFIG_X is not set") == (b"CONFIG_X", b" is", b" not set")
+        passes = passes and uncomment_change([b"# CONFIG_X is not set"], b"CONFIG_X", b"y") == [b"CONFIG_X=y"]
+        use_dialect("ini")
+        passes = passes and splitassignment(b"; port=1") == (None, None, None)
+        passes = passes and change([b"; port=1", b"port: 2"], b"port", b"3") == [b"; port=1", b"port: 3"]
+        passes = passes and uncomment([b"; port=1"], b"port") == [b"port=1"]
+        use_dialect("make")
+        passes = passes and splitassignment(b"file.o: file.c") == (None, None, None)
+        passes = passes and splitassignment(b"X ::= 1") == (b"X ", b"::=", b" 1")
+        use_dialect("yaml")
+        passes = passes and change([b"a = b: 1", b"b: 2"], b"b", b"3") == [b"a = b: 1", b"b: 3"]
+    finally:
+        use_dialect(previous)
+    # Use a dialect from the command line, then go back to the generic one
+    directory = mkdtemp()
+    try:
+        filename = join(directory, "a.ini")
+        with open(filename, 'wb') as f:
+            f.write(b"; port=1\nport=2\n")
+        main(["--dialect=auto", filename, "port", "3"])
+        with open(filename, 'rb') as f:
+            passes = passes and f.read() == b"; port=1\nport=3\n"
+        passes = passes and use_dialect(None) is GENERIC
+        main(["--dialect", "generic", filename, "port", "4"])
+        with open(filename, 'rb') as f:
+            passes = passes and f.read() == b"; port=1\nport=4\n"
+    finally:
+        rmtree(directory)
+    print("Dialects passes: %s" % (passes))
+    return passes
+
+
+def test_transaction():
+    directory = mkdtemp()
+    passes = True
+    try:
+        a, b, c = join(directory, "a.conf"), join(directory, "b.conf"), join(directory, "c.conf")
+        for filename in [a, b]:
+            with open(filename, 'wb') as f:
+                f.write(b"x=1" + NL)
+        chmod(b, 0o640)
+        # All the files are changed together, and new files are created for "add" edits
+        with Transaction(sync=True) as transaction:
+            transaction.set(a, "x", "2")
+            transaction.batch(b, [("set", "x", "3"), ("add", "y", "4")])
+            transaction.batch(c, [("add", "z", "5")])
+            transaction.set(a, "x", "6")
+        for filename, contents in [(a, b"x=6" + NL), (b, b"x=3" + NL + b"y=4" + NL), (c, b"z=5" + NL)]:
+            with open(filename, 'rb') as f:
+                passes = passes and f.read() == contents
+        passes = passes and S_IMODE(stat(b).st_mode) == 0o640
+        # Unchanged files are not written
+        transaction = Transaction()
+        transaction.set(a, "x", "6")
+        passes = passes and transaction.commit() == []
+        # Nothing is written if an error happens before the commit
+        try:
+            with Transaction() as transaction:
+                transaction.set(a, "x", "7")
+                transaction.set(join(directory, "missing.conf"), "x", "7")
+            passes = False
+        except (IOError, OSError):
+            pass
+        # The files that were replaced are put back if one of the files can not be replaced
+        transaction = Transaction()
+        transaction.set(a, "x", "8")
+        transaction.set(c, "z", "9")
+        remove(c)
+        mkdir(c)
+        with open(join(c, "file"), 'wb') as f:
+            f.write(b"")
+        try:
+            transaction.commit()
+            passes = False
+        except (IOError, OSError):
+            pass
+        with open(a, 'rb') as f:
+            passes = passes and f.read() == b"x=6" + NL
+        passes = passes and sorted(listdir(directory)) == ["a.conf", "b.conf", "c.conf"]
+        # From the command line, with one filename and change per line
+        edits = join(directory, "edits.txt")
+        with open(edits, 'wb') as f:
+            f.write(b"# Comment" + NL + bs(a) + b" x 10" + NL + bs(b) + b" -a z=11" + NL)
+        main(["--transaction", edits])
+        with open(a, 'rb') as f:
+            passes = passes and f.read() == b"x=10" + NL
+        with open(b, 'rb') as f:
+            passes = passes and f.read() == b"x=3" + NL + b"y=4" + NL + b"z=11" + NL
+    finally:
+        rmtree(directory)
+    print("Transaction passes: %s" % (passes))
+    return passes
+
+
+def test_check():
+    directory = mkdtemp()
+    passes = True
+    try:
+        a, b = join(directory, "a.conf"), join(directory, "b.conf")
+        for filename in [a, b]:
+            with open(filename, 'wb') as f:
+                f.write(b"x=1" + NL)
+        # The first change ends the run, and nothing is written
+        check = start_check()
+        try:
+            changefile(a, "x", "1")
+            passes = passes and check.changed == []
+            changefile(a, "x", "2")
+            passes = False
+        except ChangesFound:
+            pass
+        finally:
+            passes = passes and stop_check() is check and check.changed == [a]
+        for args, code in [(["--check", a, "x", "1"], None), (["--check", a, "x", "2"], 1), (["--check", a], 2),
+                           (["--check", "-a", join(directory, "c.conf"), "y", "1"], 1),
+                           (["--check", "-m", directory, "--", "x", "1"], None),
+                           (["--check", "-m", directory, "--", "x", "3"], 1)]:
+            try:
+                passes = passes and main(args) is None and code is None
+            except SystemExit as e:
+                passes = passes and e.code == code
+        passes = passes and sorted(listdir(directory)) == ["a.conf", "b.conf"]
+        # The changes are kept in memory, so that later changes see them
+        output = BytesIO()
+        check = start_check(diff=True, output=output)
+        try:
+            changefile(a, "x", "5")
+            changefile(a, "x", "6")
+            passes = passes and check.changed == [a] and check.read(a) == b"x=6" + NL
+        finally:
+            stop_check()
+        header = b"--- " + bs(a) + b"\n+++ " + bs(a) + b"\n@@ -1 +1 @@\n"
+        passes = passes and output.getvalue() == header + b"-x=1\n+x=5\n" + header + b"-x=5\n+x=6\n"
+        with open(a, 'rb') as f:
+            passes = passes and f.read() == b"x=1" + NL
+    finally:
+        rmtree(directory)
+    print("Check passes: %s" % (passes))
+    return passes
+
+
+def test_watch():
+    if not platform.startswith("linux"):
+        # inotify is only available on Linux
+        print("Watch passes: %s" % (True))
+        return True
+    directory = mkdtemp()
+    passes = True
+    try:
+        a, b = join(directory, "a.conf"), join(directory, "b.conf")
+        for filename in [a, b]:
+            with open(filename, 'wb') as f:
+                f.write(b"x=1" + NL)
+        calls = []
+
+        def apply(changed):
+            calls.append(changed)
+            changefile(a, "x", "2")
+            return len(calls) < 2
+
+        def write():
+            # Written twice in a row, and by renaming, like many editors do
+            sleep(0.2)
+            for contents in [b"x=3" + NL, b"x=4" + NL + b"y=5" + NL]:
+                with open(a + ".new", 'wb') as f:
+                    f.write(contents)
+                replace(a + ".new", a)
+
+        thread = Thread(target=write)
+        thread.start()
+        watch([a, b], apply, delay=0.1)
+        thread.join()
+        # The writes by apply are skipped, and the burst of writes is handled at once
+        passes = passes and calls == [[a, b], [a]]
+        with open(a, 'rb') as f:
+            passes = passes and f.read() == b"x=2" + NL + b"y=5" + NL
+        # A write by something else right after apply is not mistaken for the write by apply
+        calls = []
+
+        def racing_apply(changed):
+            calls.append(changed)
+            changefile(a, "x", "2")
+            if len(calls) == 1:
+                with open(a, 'wb') as f:
+                    f.write(b"x=99" + NL)
+            return len(calls) < 2
+
+        def write_b():
+            # Ends the watch if the write to a is missed
+            sleep(0.5)
+            with open(b, 'wb') as f:
+                f.write(b"x=6" + NL)
+
+        thread = Thread(target=write_b)
+        thread.start()
+        watch([a, b], racing_apply, delay=0.1)
+        thread.join()
+        passes = passes and calls == [[a, b], [a]]
+        with open(a, 'rb') as f:
+            passes = passes and f.read() == b"x=2" + NL
+    finally:
+        rmtree(directory)
+    print("Watch passes: %s" % (passes))
+    return passes
+
+
+def tests():
+    # If one test fails, the rest will not be run
+    passes = True
+    passes = passes and test_splitassignment()
+    passes = passes and test_changeline()
+    passes = passes and test_change()
+    passes = passes and test_change_define()
+    passes = passes and test_changefile()
+    passes = passes and test_change_multiline()
+    passes = passes and test_changefile_multiline()
+    passes = passes and test_addline()
+    passes = passes and test_latin1()
+    passes = passes and test_uncomment()
+    passes = passes and test_uncomment_change()
+    passes = passes and test_change_data()
+    passes = passes and test_changefile_uncomment()
+    passes = passes and test_changefile_uncomment_kernel()
+    passes = passes and test_changefile_batch()
+    passes = passes and test_nth()
+    passes = passes and test_streamfile()
+    passes = passes and test_filter()
+    passes = passes and test_writefile()
+    passes = passes and test_changefiles()
+    passes = passes and test_daemon()
+    passes = passes and test_configfile()
+    passes = passes and test_stats()
+    passes = passes and test_merge()
+    passes = passes and test_get_values()
+    passes = passes and test_async()
+    passes = passes and test_cache()
+    passes = passes and test_dialects()
+    passes = passes and test_transaction()
+    passes = passes and test_check()
+    passes = passes and test_watch()
+    if passes:
+        print("All tests pass!")
+    else:
+        print("Tests fail.")
+
+
+if __name__ == "__main__":
+    tests()
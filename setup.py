@@ -11,10 +11,11 @@ setup(name="setconf",
       author="Alexander F. Rødseth",
       author_email="xyproto@archlinux.org",
       license="GPLv2",
-      py_modules=["setconf"],
+      py_modules=["setconf", "setconf_client", "setconf_tests"],
       entry_points={
           "console_scripts": [
               "setconf = setconf:main",
+              "setconf-client = setconf_client:main",
           ]
       },
       classifiers=[
@@ -51,6 +51,10 @@ start kernel_config
 ../setconf.py -u kernel_config CONFIG_ULTRIX_PARTITION=y
 complete kernel_config
 
+start merge
+../setconf.py --merge merge merge.fragment
+complete merge
+
 start small
 ../setconf.py -u small f 42
 complete small
@@ -76,3 +80,7 @@ complete multiline
 start sh
 ../setconf.py sh name newvalue
 complete sh
+
+start diff
+../setconf.py --check diff x 2 || ../setconf.py --diff diff x 2 >> diff
+complete diff